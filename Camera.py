@@ -40,6 +40,10 @@ class Camera():
         self.camera_offset[1] = self.camera_position[1] + self._mount_dimensions[1]
         self.camera_offset[2] = self.camera_position[2] + self.focal_length + self._mount_dimensions[2]
     
+    @property
+    def name(self):
+        return self._name
+
     @property
     def mount_depth(self):
         if self._mount_dimensions:
@@ -0,0 +1,262 @@
+"""
+Cycle time benchmark: scans a sheet from motionplanning.get_coords against the simulators and
+reports tiles/min and the per phase latencies from the trace.
+
+    python benchmark.py                      # both modes, compared with benchmark_baseline.json
+    python benchmark.py --save-baseline      # store this run as the new baseline
+    python benchmark.py --tiles 10 --speed 4 # first 10 tiles, every latency 4x shorter
+    python benchmark.py --results stream     # exports from the data stream instead of the GUI
+    python benchmark.py --modules            # RAPID module size/generation time, unrolled vs loop layout
+
+Latencies are estimates of the cell, see LATENCIES. A run is only compared with a baseline
+taken with the same mode, result source, tile order, tile count and speed. Exits with 1 if anything regressed.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from datetime import datetime
+from scanner_control import MicroEpsilonDriver, Crb, scan_loop
+from orchestrator import scan_sheet
+from simulator import RobotSimulator, SensorSimulator, InspectSimulator
+from result_collector import StreamResultCollector, DirectoryResultCollector, SheetExport, use_collector
+from motionplanning import get_coords, get_surface_coords, plate_offset, motion_modules, write_modules, surface_control
+from motionplanning import sheet_dimensions, sheet_mount_dimensions
+from tile_order import ORDERINGS, plan_tiles, print_plans, move_time, distance
+from tracing import Tracer, TRACE_DIR, summarize, print_summary
+
+# Seconds, at speed 1
+LATENCIES = {
+    "move_time": 0.8,        # robot travel to the first tile, later moves take tile_order.move_time
+    "settle_time": 0.2,      # RAPID WaitTime after WaitRob \InPos
+    "auto_mode_time": 0.1,   # 150 -> 1
+    "exposure_time": 0.3,    # state 2
+    "processing_time": 0.2,  # state 3
+    "evaluation_time": 0.1,  # state 4
+    "ack_time": 0.05,        # 5 -> 1 after Q_ResultsAck
+    "status_time": 0.2,      # one read_status_text through UIA
+    "export_time": 1.0,      # File -> Export defects
+}
+
+MODES = ("sequential", "pipelined")
+RESULT_SOURCES = ("gui", "stream", "directory", "sheet") # gui is the simulated 3DInspect export
+BASELINE_PATH = "benchmark_baseline.json"
+TOLERANCE = 0.10  # fractional slowdown allowed before it counts as a regression
+MIN_DELTA = 0.005 # s, phase changes smaller than this are noise
+MODULE_LAYOUTS = ("unrolled", "loop")
+TILE_DIVISIONS = (1, 4, 10, 20) # the camera's scan area divided by this per axis, for finer tilings
+
+
+def run_benchmark(coords, mode = "sequential", speed = 1.0, results = "gui", order = "raster", trace_dir = TRACE_DIR):
+    """Scan coords against fresh simulators. Returns a result dict (see print_report)."""
+    latency = {name: value / speed for name, value in LATENCIES.items()}
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    tracer = Tracer(os.path.join(trace_dir, f"benchmark_{mode}_{timestamp}.jsonl"))
+    work_dir = tempfile.TemporaryDirectory()
+    auto_export_dir = os.path.join(work_dir.name, "auto")
+    export_dir = os.path.join(work_dir.name, "exports")
+    os.makedirs(auto_export_dir)
+
+    robot = RobotSimulator(move_time=latency["move_time"], settle_time=latency["settle_time"],
+                           travel=lambda a, b: move_time(distance(a, b)) / speed)
+    sensor = SensorSimulator(
+        auto_mode_time=latency["auto_mode_time"],
+        exposure_time=latency["exposure_time"],
+        processing_time=latency["processing_time"],
+        evaluation_time=latency["evaluation_time"],
+        ack_time=latency["ack_time"],
+        export_dir=auto_export_dir if results == "directory" else None,
+    )
+    inspect = InspectSimulator(sensor, status_time=latency["status_time"], export_time=latency["export_time"])
+
+    with robot, sensor, work_dir:
+        driver = MicroEpsilonDriver(sensor.host, modbus_port=sensor.modbus_port, data_port=sensor.data_port)
+        if results == "stream":
+            collector = StreamResultCollector(driver, export_dir)
+        elif results == "directory":
+            collector = DirectoryResultCollector(auto_export_dir, export_dir)
+        elif results == "sheet":
+            collector = SheetExport(export_dir)
+        else:
+            collector = inspect
+        use_collector(driver, collector)
+        driver.connect()
+        crb = Crb(robot.host, robot.port)
+        driver.tracer = crb.tracer = tracer
+
+        start = time.perf_counter()
+        try:
+            if mode == "pipelined":
+                scan_sheet(driver, crb, coords)
+            else:
+                scan_loop(driver, crb, coords)
+            driver.finish_sheet()
+            sheet_time = time.perf_counter() - start
+        finally:
+            driver.exit_to_manual_mode()
+            driver.close(crb)
+            tracer.close()
+        if results == "sheet":
+            exports = len(collector.rows)
+        elif results == "gui":
+            exports = len(inspect.exports)
+        else:
+            # One cumulative export, a row per tile
+            exports = len(collector.lines)
+
+    return {
+        "mode": mode,
+        "tiles": len(coords),
+        "speed": speed,
+        "results": results,
+        "order": order,
+        "sheet_time": sheet_time,
+        "tiles_per_min": len(coords) / sheet_time * 60,
+        "exports": exports,
+        "modbus_per_tile": driver.registers.round_trips / len(coords),
+        "trace": tracer.path,
+        "phases": summarize(tracer.path),
+    }
+
+
+def compare(result, baseline, tolerance = TOLERANCE):
+    """Regressions of result against a baseline result, as printable lines."""
+    regressions = []
+    if result["tiles_per_min"] < baseline["tiles_per_min"] * (1 - tolerance):
+        regressions.append(
+            f"tiles/min {result['tiles_per_min']:.2f} < baseline {baseline['tiles_per_min']:.2f}")
+    for name, phase in result["phases"].items():
+        base = baseline["phases"].get(name)
+        if not base:
+            continue
+        for stat in ("p50", "p95"):
+            if phase[stat] > base[stat] * (1 + tolerance) + MIN_DELTA:
+                regressions.append(
+                    f"{name} {stat} {phase[stat] * 1000:.1f} ms > baseline {base[stat] * 1000:.1f} ms")
+    return regressions
+
+
+def comparable(result, baseline):
+    return all(result[key] == baseline[key] for key in ("mode", "results", "order", "tiles", "speed"))
+
+
+def baseline_key(result):
+    return f"{result['mode']}/{result['results']}/{result['order']}"
+
+
+def load_baseline(path = BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_baseline(results, path = BASELINE_PATH):
+    baseline = load_baseline(path)
+    for result in results:
+        baseline[baseline_key(result)] = {key: value for key, value in result.items() if key != "trace"}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(baseline, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def print_report(result):
+    print(f"\n=== {result['mode']}, {result['results']} results, {result['order']} order: "
+          f"{result['tiles']} tiles at speed {result['speed']} ===")
+    print(f"Sheet time {result['sheet_time']:.2f} s, {result['tiles_per_min']:.2f} tiles/min, "
+          f"{result['exports']} exports, {result['modbus_per_tile']:.1f} Modbus round trips/tile, "
+          f"trace {result['trace']}")
+    print_summary(result["phases"])
+
+
+def module_benchmark(divisions = TILE_DIVISIONS, repeat = 3):
+    """Size and generation time of the RAPID modules for ever finer tilings of the configured sheet, per layout."""
+    offset = plate_offset(sheet_dimensions, sheet_mount_dimensions, surface_control)
+    results = []
+    for division in divisions:
+        scan_area = [length / division for length in surface_control.scan_area]
+        coords = get_surface_coords(sheet_dimensions, scan_area, offset)
+        for layout in MODULE_LAYOUTS:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                modules = motion_modules(coords=[list(c) for c in coords], wait_time=1, orientation="parallel_3",
+                                         camera_type=surface_control, ordering=None, layout=layout)
+                with tempfile.TemporaryDirectory() as out_dir:
+                    write_modules(modules, os.path.join(out_dir, "motion.modx"))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results.append({
+                "layout": layout,
+                "targets": len(coords),
+                "modules": len(modules),
+                "bytes": sum(len(module.encode()) for module in modules),
+                "largest": max(len(module.encode()) for module in modules),
+                "lines": sum(module.count("\n") + 1 for module in modules),
+                "time": best,
+            })
+    return results
+
+
+def print_module_report(results):
+    print(f"{'layout':<10}{'targets':>9}{'modules':>9}{'kB':>10}{'largest kB':>12}{'lines':>9}{'ms':>9}")
+    for result in results:
+        print(f"{result['layout']:<10}{result['targets']:>9}{result['modules']:>9}{result['bytes'] / 1000:>10.1f}"
+              f"{result['largest'] / 1000:>12.1f}{result['lines']:>9}{result['time'] * 1000:>9.1f}")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Cycle time benchmark against the simulated cell")
+    parser.add_argument("--mode", choices=MODES + ("both",), default="both")
+    parser.add_argument("--tiles", type=int, default=None, help="only scan the first N tiles")
+    parser.add_argument("--results", choices=RESULT_SOURCES, default="gui", help="where tile exports come from")
+    parser.add_argument("--order", choices=ORDERINGS, default="raster", help="tile visiting order")
+    parser.add_argument("--speed", type=float, default=1.0, help="divide every latency by this")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--modules", action="store_true", help="compare RAPID module layouts instead of scanning")
+    args = parser.parse_args(argv)
+
+    if args.modules:
+        print_module_report(module_benchmark())
+        return 0
+
+    plan = plan_tiles(get_coords(), args.order)
+    print_plans([plan])
+    coords = plan.coords
+    if args.tiles:
+        coords = coords[:args.tiles]
+
+    modes = MODES if args.mode == "both" else (args.mode,)
+    results = [run_benchmark(coords, mode, args.speed, args.results, args.order) for mode in modes]
+
+    baseline = load_baseline(args.baseline)
+    regressed = False
+    for result in results:
+        print_report(result)
+        base = baseline.get(baseline_key(result))
+        if not base:
+            print("No baseline for this mode, result source and tile order.")
+        elif not comparable(result, base):
+            print(f"Baseline was taken with {base['tiles']} tiles at speed {base['speed']}, not compared.")
+        else:
+            regressions = compare(result, base, args.tolerance)
+            for line in regressions:
+                print(f"❌ REGRESSION {line}")
+            if not regressions:
+                print(f"✅ No regressions ({base['tiles_per_min']:.2f} tiles/min in baseline)")
+            regressed = regressed or bool(regressions)
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,26 @@ wait_time = 1
 digital_output = "ABB_Scalable_IO_0_DO1"
 digital_input = "ABB_Scalable_IO_0_DI1"
 socket_ip = "\"192.168.125.1\"" # needs quotation marks!
+ROBOT_FRAME_SIZE = 40 # bytes per host -> robot socket frame, RAPID reads exactly this many
+PART_NUMBER = "default" # product being scanned, recipes (recipes.py) are cached per part
+RECIPE_DIR = "recipes"
+TILE_ORDER = "raster" # "raster", "serpentine", "nearest" or "singularity", see tile_order.py
+SCAN_PLAN_NAME = "scan_plan.json" # tile -> grid cell mapping, read back by data_processing/pre_process_data
+
+# --- CONTINUOUS LINE SCAN (scan_control) ---
+# "stop" moves to fine points with a READY handshake at every target, "continuous" flies constant speed
+# passes over the sheet with the scanner gated by the pulse output (TriggL, see motionplanning)
+SCAN_MODE = "stop"
+PROFILE_SPACING = 0.5 # mm between two scanCONTROL profiles along a pass
+PROFILE_RATE = 300    # Hz, scanCONTROL profile frequency; pass speed = PROFILE_SPACING * PROFILE_RATE
+SCAN_RUN_IN = 20      # mm at scan speed before and after the sheet, at least the distance to accelerate
+SCAN_ZONE = "z10"     # zone data between passes
+
+# --- RAPID MODULE LAYOUT ---
+# "unrolled": a robtarget and a move block per target, "loop": target arrays visited by one FOR loop
+# (surface control), split into data modules of MODULE_CHUNK_TARGETS targets for large plans
+MODULE_LAYOUT = "unrolled"
+MODULE_CHUNK_TARGETS = 500
 
 
 # --- SCANNER CONFIGURATION ---
@@ -18,11 +38,26 @@ IP_ADDRESS = '127.0.0.1'
 MODBUS_PORT = 502
 DATA_PORT = 502  # For the TCP data stream
 
+# --- RESULT COLLECTION ---
+# Where a tile's defects come from: "gui" drives File -> Export in 3DInspect (defect_saver, Windows
+# only), "stream" writes them from the sensor data port, "directory" picks up 3DInspect's auto export,
+# "sheet" collects the data port results of the whole sheet into one export
+RESULT_SOURCE = "gui"
+EXPORT_DIR = r"data_processing/data_output/temp" # exports for "stream", "directory" and "sheet"
+AUTO_EXPORT_DIR = None                            # folder 3DInspect auto exports into, for "directory"
+SHEET_EXPORT_NAME = "sheet_defects.txt"           # read back by data_processing/pre_process_data
+POSITION_COLUMNS = ("X [mm]", "Y [mm]", "Z [mm]") # robot position of each tile, after Date Time in the sheet export
+SHEET_FLUSH_TILES = 10                            # rewrite the sheet export every this many tiles
+
 # --- REGISTER MAP (Based on MEAutomationInterface.pdf) ---
 # Holding Registers (Outputs to Sensor) - Offset = Register Number - 1
 REG_CONTROL_SMART = 3   # Register 4 in manual (Smart Control)
 # Input Registers (Inputs from Sensor)
 REG_STATUS_ACQ    = 1   # Register 2 in manual (IB_StateAcquisition)
+REG_RESULTS       = 2   # Registers 3-8 in manual: measurement counter, then the inspection program's results
+REG_RESULT_COUNT  = 6
+REG_INPUT_BLOCK   = 0   # Status and result registers are read together, starting here
+REG_INPUT_COUNT   = 8   # ...this many of them in one request
 
 # --- CONTROL BITS (Register 4) ---
 BIT_AUTO_MODE  = 1   # Bit 0: Q_AutomaticMode (Value 1)
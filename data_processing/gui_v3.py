@@ -10,12 +10,31 @@ import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 
 import process_data_v3
+import pre_process_data
+import stream_ingest
+import pyramid
+from tile_cache import TileCache
 import os
 import shutil
 from datetime import datetime
 
 DEFAULT_DIR = r'data_output/20251211' # should be temp but this is for testing
 # DEFAULT_DIR = r'data_output/temp'
+LIVE_DIR = r'data_output/temp' # where the scanner writes tiles during a sheet
+STREAM_POLL_MS = 500
+TILE_CACHE_BYTES = 256 * 1024 * 1024 # decoded tile images kept for the click-through view
+
+
+def open_image(path):
+    """PIL image with its pixels read, so the file isn't held open."""
+    img = Image.open(path)
+    img.load()
+    return img
+
+
+def image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
 
 class DynamicImageApp:
     def __init__(self, root):
@@ -27,6 +46,14 @@ class DynamicImageApp:
         
         self.show_annotations = False
         self.showing_main = True
+        self.stream = None
+        self.stream_job = None
+        self.tile_images = TileCache(TILE_CACHE_BYTES, decode=open_image, nbytes=image_bytes)
+        self.images = []
+        self.grid_index = None
+        self.pyramid_key = None
+        self.pyramid = None
+        self.pyramid_levels = {}
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
@@ -57,6 +84,9 @@ class DynamicImageApp:
         self.reload_btn = ttk.Button(self.top_bar, text="Reload", command=self.reload_directory, style="custom.TButton")
         self.reload_btn.pack(side="left", padx=5, pady=5)        
 
+        self.live_btn = ttk.Button(self.top_bar, text="Go Live", command=self.toggle_live, style="custom.TButton")
+        self.live_btn.pack(side="left", padx=5, pady=5)
+
         self.ann_btn = ttk.Button(self.top_bar, text="Show Annotations", command=self.toggle_annotations, style="custom.TButton")
         self.ann_btn.pack(side="right", padx=5, pady=5)
 
@@ -74,6 +104,12 @@ class DynamicImageApp:
         # Bind resizing + clicking
         self.canvas.bind("<Configure>", self.on_resize)
         self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<Motion>", self.on_hover)
+        self.canvas.bind("<Leave>", self.on_leave)
+
+        # Defect count tooltip for the cell under the mouse
+        self.hover_label = tk.Label(self.canvas, bg="#333333", fg="white", justify="left", font=("Arial", 10), padx=6, pady=3)
+        self.hover_cell = None
 
         self.load_directory(self.active_directory)
 
@@ -95,13 +131,11 @@ class DynamicImageApp:
         # if os.path.basename(directory) == "temp":
         #     directory = os.path.abspath(directory).replace("temp", "working")
 
-        self.images = [
-            (Image.open(path), row, col)
-            for (path, row, col) in process_data_v3.img_unann_grid
-        ]
+        self.images = list(process_data_v3.img_unann_grid)
         self.sheet_size = process_data_v3.sheet_dimensions
         self.grid_size = process_data_v3.grid_size
         self.camera_grid = process_data_v3.camera_grid
+        self.grid_index = process_data_v3.grid_index
         self.main_original = Image.open(process_data_v3.img_unann_stitched)
         self.current_original = self.main_original
         self.showing_main = True
@@ -133,9 +167,35 @@ class DynamicImageApp:
         self.offset_x = (canvas_w - new_w) // 2
         self.offset_y = (canvas_h - new_h) // 2
         
+        if img is self.main_original:
+            img = self.pyramid_image(img, new_w, new_h)
         resized = img.resize((new_w, new_h), Image.LANCZOS)
         return ImageTk.PhotoImage(resized)
 
+    def pyramid_image(self, img, new_w, new_h):
+        """Smallest pyramid level that still covers new_w x new_h, so LANCZOS never runs on the full mosaic."""
+        path = getattr(img, "filename", None)
+        if not path or not os.path.exists(path):
+            return img
+
+        key = (path, os.path.getmtime(path))
+        if key != self.pyramid_key:
+            self.pyramid_key = key
+            self.pyramid = pyramid.Pyramid.open(path)
+            self.pyramid_levels = {}
+        if not self.pyramid:
+            return img
+
+        viewport = (0, 0, self.pyramid.width, self.pyramid.height)
+        level, tiles = self.pyramid.tiles(viewport, (new_w, new_h))
+        if level not in self.pyramid_levels:
+            level_img = Image.new(img.mode, tuple(self.pyramid.levels[level]))
+            for tile_path, position in tiles:
+                with Image.open(tile_path) as tile:
+                    level_img.paste(tile, position)
+            self.pyramid_levels[level] = level_img
+        return self.pyramid_levels[level]
+
     def on_resize(self, event):
         self.display_image()
 
@@ -169,24 +229,36 @@ class DynamicImageApp:
         if adj_x >= self.image_w or adj_y >= self.image_h:
             return
 
-        cell_width  = self.image_w  // self.grid_size[1]
-        cell_height = self.image_h // self.grid_size[0]
+        cell = self.grid_index.cell_at(adj_x, adj_y, self.image_w, self.image_h)
+        if cell:
+            img_path = self.images[self.grid_index.tile(*cell)][0]
+            self.show_sub(img_path, self.grid_index.coord(*cell))
+
+    def on_hover(self, event):
+        cell = None
+        if self.showing_main and self.grid_index and hasattr(self, "image_w"):
+            cell = self.grid_index.cell_at(event.x - self.offset_x, event.y - self.offset_y, self.image_w, self.image_h)
 
-        for filename, row, column in self.images:
-            x0 = column * cell_width
-            x1 = x0 + cell_width
+        if not cell:
+            self.hover_cell = None
+            self.hover_label.place_forget()
+            return
 
-            y0 = row * cell_height
-            y1 = y0 + cell_height
+        if cell != self.hover_cell:
+            self.hover_cell = cell
+            count = self.grid_index.defect_count(*cell)
+            coord = self.grid_index.coord(*cell)
+            self.hover_label.config(text=f"{count} defect{'s' if count != 1 else ''}\nPosition: {coord[1]:.1f}, {coord[0]:.1f}")
+        self.hover_label.place(in_=self.canvas, x=event.x + 15, y=event.y + 15)
 
-            if x0 <= adj_x < x1 and y0 <= adj_y < y1:
-                camera_coord = (self.camera_grid[0][row],self.camera_grid[1][column])
-                self.show_sub(filename, camera_coord)
-                return
+    def on_leave(self, event):
+        self.hover_cell = None
+        self.hover_label.place_forget()
 
-    def show_sub(self, img, camera_coord):
-        self.current_original = img
+    def show_sub(self, img_path, camera_coord):
+        self.current_original = self.tile_images.read(img_path)
         self.showing_main = False
+        self.hover_label.place_forget()
         self.home_btn.pack(side="right", padx=5)
         self.top_info.pack_forget()
         self.top_info = tk.Label(self.canvas_frame, text=f"Image position on sheet: {camera_coord[1]}, {camera_coord[0]}", anchor="center", font=self.button_font)
@@ -205,11 +277,11 @@ class DynamicImageApp:
     def choose_directory(self):
         initial_dir = os.path.dirname(self.active_directory)
         if os.path.basename(initial_dir) == "temp":
+            # The working directory is kept, process_data_v3 clears it itself when a new sheet arrives
+            self.close_images()
             self.main_original = Image.open("../empty.png")
             self.current_original = self.main_original
             self.display_image()
-            working_dir = os.path.abspath(initial_dir).replace("temp", "working")
-            self.delete_dir(working_dir)
 
         new_dir = filedialog.askdirectory(title="Select Image Directory", initialdir=initial_dir)
         self.active_directory = new_dir
@@ -230,12 +302,10 @@ class DynamicImageApp:
         
 
         # Rebuild images & grid
-        self.images = [
-            (Image.open(path), row, col)
-            for (path, row, col) in process_data_v3.img_unann_grid
-        ]
+        self.images = list(process_data_v3.img_unann_grid)
         self.grid_size = process_data_v3.grid_size
         self.camera_grid = process_data_v3.camera_grid
+        self.grid_index = process_data_v3.grid_index
 
         # Update main stitched
         self.main_original = Image.open(process_data_v3.img_unann_stitched)
@@ -260,24 +330,25 @@ class DynamicImageApp:
             grid = process_data_v3.img_unann_grid
             stitched = process_data_v3.img_unann_stitched
 
+        if self.stream:
+            # Only the shown mosaic is kept current while live
+            stitched = self.stream.show("annotated" if self.show_annotations else "unannotated")
+
         # Rebuild the image grid
         grid_map = {(row, col): path for (path, row, col) in grid}
-        self.images = [(Image.open(path), row, col) for (path, row, col) in grid]
+        self.images = list(grid)
         self.grid_size = process_data_v3.grid_size
         self.camera_grid = process_data_v3.camera_grid
+        self.grid_index = process_data_v3.grid_index
 
         if not self.showing_main:
             current_filename = os.path.basename(self.current_original.filename)
             self.main_original = Image.open(stitched)
 
-            # Find matching row/col from previous grid
-            for (path, row, col) in (process_data_v3.img_ann_grid +
-                                    process_data_v3.img_unann_grid):
-                if os.path.basename(path) == current_filename:
-                    # Load the corresponding annotated/unannotated version
-                    new_path = grid_map[(row, col)]
-                    self.current_original = Image.open(new_path)
-                    break
+            # Load the corresponding annotated/unannotated version
+            cell = self.grid_index.cell_of(current_filename)
+            if cell:
+                self.current_original = self.tile_images.read(grid_map[cell])
         else:
             self.main_original = Image.open(stitched)
             self.current_original = self.main_original
@@ -296,6 +367,10 @@ class DynamicImageApp:
             save_dir = os.path.join(save_dir_parent, f"output_{timestamp}")
         
             try:
+                # The pipeline reads the .txt export directly, saved scans still get a CSV copy
+                for filename in os.listdir(working_dir):
+                    if filename.lower().endswith(".txt"):
+                        pre_process_data.lazy_csv(os.path.join(working_dir, filename))
                 shutil.copytree(working_dir, save_dir)
                 messagebox.showinfo("Saved", f"Working directory saved to:\n{save_dir}")
             except Exception as e:
@@ -308,12 +383,10 @@ class DynamicImageApp:
             messagebox.showerror("Error", "No valid directory loaded to reload.")
             return
 
-        if os.path.basename(current_dir) == "temp":
-            self.main_original = Image.open("../empty.png")
-            self.current_original = self.main_original
-            self.display_image()
-            working_dir = os.path.abspath(current_dir).replace("temp", "working")
-            self.delete_dir(working_dir)
+        # The working directory is kept, process_data_v3 only redoes the stages whose inputs changed
+        self.close_images()
+        self.main_original = Image.open("../empty.png")
+        self.current_original = self.main_original
 
         # Re-run processing
         try:
@@ -334,12 +407,10 @@ class DynamicImageApp:
         stitched = process_data_v3.img_unann_stitched
 
         # Rebuild image grid
-        self.images = [
-            (Image.open(path), row, col)
-            for (path, row, col) in grid
-        ]
+        self.images = list(grid)
         self.grid_size = process_data_v3.grid_size
         self.camera_grid = process_data_v3.camera_grid
+        self.grid_index = process_data_v3.grid_index
 
         # Reset main stitched image
         self.main_original = Image.open(stitched)
@@ -353,15 +424,81 @@ class DynamicImageApp:
         self.display_image()
 
 
+    def toggle_live(self):
+        """Follow the scanner's temp directory, adding each tile to the view as soon as it is written."""
+        if self.stream:
+            self.stop_live()
+            return
+
+        try:
+            self.stream = stream_ingest.StreamIngest(LIVE_DIR)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to start live view:\n{e}")
+            return
+
+        self.stream.shown = "annotated" if self.show_annotations else "unannotated"
+        self.active_directory = LIVE_DIR
+        self.dir_label.config(text=f"Current directory: {os.path.basename(self.active_directory)} (live)")
+        self.live_btn.config(text="Stop Live")
+        self.poll_stream()
+
+    def stop_live(self):
+        if self.stream_job:
+            self.root.after_cancel(self.stream_job)
+        if self.stream:
+            # Mosaics not shown are only written once, here or when the sheet completes
+            self.stream.save_all()
+        self.stream = None
+        self.stream_job = None
+        self.live_btn.config(text="Go Live")
+        self.dir_label.config(text=f"Current directory: {os.path.basename(self.active_directory)}")
+
+    def poll_stream(self):
+        self.stream_job = None
+        try:
+            if self.stream.poll():
+                self.refresh_from_stream()
+        except Exception as e:
+            self.stop_live()
+            messagebox.showerror("Error", f"Live view stopped:\n{e}")
+            return
+
+        if self.stream.complete:
+            self.stop_live()
+        else:
+            self.stream_job = self.root.after(STREAM_POLL_MS, self.poll_stream)
+
+    def refresh_from_stream(self):
+        if self.show_annotations:
+            grid = process_data_v3.img_ann_grid
+            stitched = process_data_v3.img_ann_stitched
+        else:
+            grid = process_data_v3.img_unann_grid
+            stitched = process_data_v3.img_unann_stitched
+
+        self.images = list(grid)
+        self.sheet_size = process_data_v3.sheet_dimensions
+        self.grid_size = process_data_v3.grid_size
+        self.camera_grid = process_data_v3.camera_grid
+        self.grid_index = process_data_v3.grid_index
+
+        # Load now so the file isn't held open while the next tile rewrites it
+        self.main_original = Image.open(stitched)
+        self.main_original.load()
+        if self.showing_main:
+            self.current_original = self.main_original
+            self.display_image()
+
     def load_default(self):
         process_data_v3.main(DEFAULT_DIR)
         self.refresh_from_processed()
 
 
     def refresh_from_processed(self):
-        self.images = [(Image.open(path), row, col) for (path, row, col) in process_data_v3.img_unann_grid]
+        self.images = list(process_data_v3.img_unann_grid)
         self.grid_size = process_data_v3.grid_size
         self.camera_grid = process_data_v3.camera_grid
+        self.grid_index = process_data_v3.grid_index
         self.main_original = Image.open(process_data_v3.img_unann_stitched)
         self.current_original = self.main_original
         self.showing_main = True
@@ -369,7 +506,8 @@ class DynamicImageApp:
         self.display_image()
 
     
-    def delete_dir(self, dir_path):
+    def close_images(self):
+        """Release the open image files so processing can overwrite or delete them."""
         try:
             if hasattr(self, "main_original") and self.main_original:
                 self.main_original.close()
@@ -380,11 +518,10 @@ class DynamicImageApp:
         except Exception:
             pass
             
-        for img, _, _ in getattr(self, "images", []):
-            try:
-                img.close()
-            except Exception:
-                pass
+        self.tile_images.clear()
+
+    def delete_dir(self, dir_path):
+        self.close_images()
 
         for root, dirs, files in os.walk(dir_path, topdown=False):
             # Delete files first
@@ -414,19 +551,19 @@ class DynamicImageApp:
 
         
     def on_close(self):
-        if os.path.basename(DEFAULT_DIR) == "temp":
-            working_dir = os.path.abspath(DEFAULT_DIR).replace("temp", "working")
-            if os.path.exists(working_dir):      
-                self.delete_dir(working_dir)
+        # The working directory (and its manifest) is kept for the next launch
+        self.close_images()
         print("App is closing… do cleanup here")
         # Example: close images, delete temp dirs, save state, etc.
         
         self.root.destroy()
 
 
-# root = tk.Tk()
-root = ttk.Window(themename="darkly")
-root.geometry("1200x900")
-root.iconbitmap("../I_logo.ico")
-app = DynamicImageApp(root)
-root.mainloop()
\ No newline at end of file
+# Guarded so the tile conversion worker processes can import this module without opening a window
+if __name__ == "__main__":
+    # root = tk.Tk()
+    root = ttk.Window(themename="darkly")
+    root.geometry("1200x900")
+    root.iconbitmap("../I_logo.ico")
+    app = DynamicImageApp(root)
+    root.mainloop()
\ No newline at end of file
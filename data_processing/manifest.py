@@ -0,0 +1,78 @@
+"""
+Record of what has already been processed in a working/output directory.
+
+Input files are hashed by content, each stage stores the key it was built from and the files it
+wrote. A stage only needs re-running when its key changes or one of its outputs has gone missing.
+Hashes are reused while a file's size and mtime are unchanged, so an untouched directory is
+checked without reading the images again.
+"""
+
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = "manifest.json"
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_values(*values):
+    """Stage key from anything json can represent (hashes, settings, file lists)."""
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Manifest:
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.path = os.path.join(data_dir, MANIFEST_NAME)
+        self.source = None
+        self.files = {}   # path relative to data_dir -> {"size", "mtime_ns", "hash"}
+        self.stages = {}  # stage name -> {"key", "outputs"}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                self.source = data.get("source")
+                self.files = data.get("files", {})
+                self.stages = data.get("stages", {})
+            except (ValueError, OSError):
+                print(f"Ignoring unreadable manifest {self.path}")
+
+    def file_hash(self, path):
+        """Content hash of a file inside data_dir, reusing the stored one if size and mtime match."""
+        rel = os.path.relpath(path, self.data_dir)
+        st = os.stat(path)
+        entry = self.files.get(rel)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["hash"]
+        digest = hash_file(path)
+        self.files[rel] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest}
+        return digest
+
+    def is_fresh(self, stage, key):
+        entry = self.stages.get(stage)
+        if not entry or entry["key"] != key:
+            return False
+        return all(os.path.exists(os.path.join(self.data_dir, p)) for p in entry["outputs"])
+
+    def record(self, stage, key, outputs):
+        self.stages[stage] = {
+            "key": key,
+            "outputs": [os.path.relpath(p, self.data_dir) for p in outputs],
+        }
+
+    def forget(self, stage):
+        self.stages.pop(stage, None)
+
+    def save(self):
+        data = {"source": self.source, "files": self.files, "stages": self.stages}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, self.path)
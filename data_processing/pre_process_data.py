@@ -1,37 +1,110 @@
 import os
 import csv
+import json
 import shutil
+import sys
+sys.path.append(os.path.abspath('..'))
+# SHEET_EXPORT_NAME: one export for the whole sheet written by scanner_control (result_collector.SheetExport),
+# a 3DInspect export with the POSITION_COLUMNS of each tile after the Date Time column.
+# SCAN_PLAN_NAME: visiting order of the sheet written by scanner_control (tile_order.save_plan)
+from config import SHEET_EXPORT_NAME, POSITION_COLUMNS, SCAN_PLAN_NAME
 
-def convert_txt_to_csv(txt_file, csv_file):
-    header_found = False
-    header = []
 
-    with open(txt_file, "r", encoding="utf-8") as infile, \
-        open(csv_file, "w", newline="", encoding="utf-8") as outfile:
+def position_columns(header):
+    """Number of robot position columns following Date Time in an export header."""
+    count = 0
+    for name in header[1:]:
+        if name.strip() not in POSITION_COLUMNS:
+            break
+        count += 1
+    return count
+
+def read_scan_plan(directory):
+    """(row, col) of every tile in the order it was scanned, or None if the scan has no plan."""
+    path = os.path.join(directory, SCAN_PLAN_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return [tuple(cell) for cell in json.load(f)["cells"]]
 
-        writer = None
 
+def split_export_line(line):
+    """Split one tab separated line of a 3DInspect export, "- - -" cells become empty."""
+    fields = [f.strip() for f in line.strip().split("\t")]
+    return ["" if f == "- - -" else f for f in fields]
+
+
+def iter_txt_export(txt_file):
+    """Yield the Date Time header and then every data row of a 3DInspect export as lists of fields."""
+    header_found = False
+    with open(txt_file, "r", encoding="utf-8") as infile:
         for line in infile:
             line = line.strip()
-            
+
             if not header_found and line.startswith("Date Time"):
                 header_found = True
-                header = [h.strip() for h in line.split("\t")]
-                writer = csv.writer(outfile)
-                writer.writerow(header)
+                yield [h.strip() for h in line.split("\t")]
                 continue
 
             if header_found and line:
-                fields = [f.strip() for f in line.split("\t")]
-                fields = ["" if f == "- - -" else f for f in fields]
-                writer.writerow(fields)
+                yield split_export_line(line)
+
+
+def convert_txt_to_csv(txt_file, csv_file):
+    with open(csv_file, "w", newline="", encoding="utf-8") as outfile:
+        writer = csv.writer(outfile)
+        for fields in iter_txt_export(txt_file):
+            writer.writerow(fields)
 
     print("CSV created:", csv_file)
     return csv_file
 
 
-def main(temp_dir, data_dir, file_transfer):
-    csv_file = None
+def lazy_csv(txt_file):
+    """CSV copy of an export, only written if it is missing or older than the export."""
+    csv_file = os.path.splitext(txt_file)[0] + ".csv"
+    if not os.path.exists(csv_file) or os.path.getmtime(csv_file) < os.path.getmtime(txt_file):
+        convert_txt_to_csv(txt_file, csv_file)
+    return csv_file
+
+
+def copy_if_changed(src, dst):
+    """Copy keeping the modification time, skipped when dst already has the same size and mtime."""
+    if os.path.exists(dst):
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+            return dst
+    return shutil.copy2(src, dst)
+
+
+def is_new_sheet(temp_dir, data_dir, num_cells):
+    """True if temp_dir holds tiles of another sheet than the one already moved into data_dir.
+    scanner_control writes a new scan_plan.json at the start of every sheet, and the copy in data_dir
+    keeps its mtime, so a plan that differs means a new sheet. Without plans, more tiles than the grid
+    has cells means the same."""
+    plan = os.path.join(temp_dir, SCAN_PLAN_NAME)
+    moved_plan = os.path.join(data_dir, SCAN_PLAN_NAME)
+    if os.path.exists(plan) and os.path.exists(moved_plan):
+        plan_stat, moved_stat = os.stat(plan), os.stat(moved_plan)
+        if plan_stat.st_size != moved_stat.st_size or plan_stat.st_mtime_ns != moved_stat.st_mtime_ns:
+            return True
+    img_dir = os.path.join(data_dir, "raw")
+    if not os.path.isdir(img_dir):
+        return False
+    moved = [f for f in os.listdir(img_dir) if f.lower().endswith(".tiff")]
+    new = [f for f in os.listdir(temp_dir) if f.lower().endswith(".tiff") and f not in moved]
+    return bool(moved) and bool(new) and len(moved) + len(new) > num_cells
+
+
+def reset_dir(data_dir):
+    """Empty data_dir for a new sheet, its manifest goes with it."""
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir, exist_ok=True)
+
+
+def main(temp_dir, data_dir, file_transfer, write_csv=False):
+    """Move or copy a scan into data_dir. Returns the defects export (.txt, read directly downstream) or None."""
+    defects_file = None
     img_dir = os.path.join(data_dir, "raw")
     os.makedirs(img_dir, exist_ok=True)
     for filename in os.listdir(temp_dir):
@@ -39,17 +112,25 @@ def main(temp_dir, data_dir, file_transfer):
         
         if filename.lower().endswith(".txt"):
             dest_path = os.path.join(data_dir, filename)
-            base = os.path.splitext(filename)[0]
-            csv_filename = base + ".csv"
-            csv_path = os.path.join(data_dir, csv_filename)
-
-            print(f"Converting {filename} → {csv_filename}")
-            csv_file = convert_txt_to_csv(temp_path, csv_path)
 
             if file_transfer == "move":
                 shutil.move(temp_path, dest_path)
             elif file_transfer == "copy":
-                shutil.copy(temp_path, dest_path)
+                copy_if_changed(temp_path, dest_path)
+            # The sheet export covers every tile, otherwise the newest export (3DInspect and the result
+            # collectors rewrite every row so far into each one)
+            if filename == SHEET_EXPORT_NAME:
+                defects_file = dest_path
+            elif defects_file is None or (os.path.basename(defects_file) != SHEET_EXPORT_NAME and
+                                          os.path.getmtime(dest_path) >= os.path.getmtime(defects_file)):
+                defects_file = dest_path
+
+            if write_csv:
+                lazy_csv(dest_path)
+
+        elif filename == SCAN_PLAN_NAME:
+            # Copied even when moving, the next sheet's scan replaces it in temp
+            copy_if_changed(temp_path, os.path.join(data_dir, filename))
 
         elif filename.lower().endswith(".tiff"):
             dest_path = os.path.join(img_dir, filename)
@@ -57,13 +138,10 @@ def main(temp_dir, data_dir, file_transfer):
                 
                 shutil.move(temp_path, dest_path)
             elif file_transfer == "copy":
-                shutil.copy(temp_path, dest_path)
+                copy_if_changed(temp_path, dest_path)
 
 
-    if csv_file:
-        return csv_file
+    if defects_file:
+        return defects_file
     else:
         return None
-
-    
-    
@@ -99,7 +99,7 @@ def main(temp_dir):
     # data_dir = os.path.abspath(temp_dir).replace("temp", "working")
     
     image_defects = []
-    csv_file = pre_process_data.main(temp_dir, data_dir, "copy")
+    csv_file = pre_process_data.lazy_csv(pre_process_data.main(temp_dir, data_dir, "copy"))
     with open(csv_file, "r", encoding="utf-8") as f:
         reader = csv.DictReader(f)
 
@@ -187,9 +187,9 @@ def main(input_dir):
     grid_size, num_rows, num_cols, camera_grid = get_grid_info(camera_coords)
 
     if os.path.basename(input_dir) == "temp":
-        csv_file = pre_process_data.main(input_dir, data_dir, "move")
+        csv_file = pre_process_data.lazy_csv(pre_process_data.main(input_dir, data_dir, "move"))
     else:
-        csv_file = pre_process_data.main(input_dir, data_dir, "copy")
+        csv_file = pre_process_data.lazy_csv(pre_process_data.main(input_dir, data_dir, "copy"))
     img_raw_dir = os.path.join(data_dir, "raw")
     unannotated_images = ConvertImages(img_raw_dir, "unannotated")
     annotated_images = ConvertImages(img_raw_dir, "annotated", csv_file=csv_file)
@@ -1,17 +1,27 @@
-import csv
+import io
+import re
 from datetime import datetime
 import os
 import glob
 import cv2
-import shutil
+import tempfile
 from cv2.gapi.streaming import timestamp
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import sys
 sys.path.append(os.path.abspath('..'))
 import smart_scan
 import motionplanning
 import pre_process_data
 import Camera
+from tile_cache import tile_cache
+import pyramid
+from manifest import Manifest, hash_values
+
+# Worker processes used for tile conversion, 1 runs everything in this process
+CONVERT_WORKERS = os.cpu_count() or 1
+# Height range in mm mapped onto the 8 bit greyscale
+COL_RANGE = (-10.0, 0.0)
 
 def get_camera_coords():
     surface_camera = Camera.surface_control
@@ -39,56 +49,116 @@ def create_save_dir(input_dir):
         data_dir = os.path.abspath(input_dir).replace("temp", "working")
     else:
         data_dir_parent = os.path.join(os.path.dirname(os.path.abspath(input_dir)), "saved")
-        data_dir = os.path.join(data_dir_parent, os.path.basename(input_dir)+f"_output_{timestamp}")
+        data_dir = find_previous_output(input_dir, data_dir_parent)
+        if not data_dir:
+            data_dir = os.path.join(data_dir_parent, os.path.basename(input_dir)+f"_output_{timestamp}")
     os.makedirs(data_dir, exist_ok=True)
     return data_dir
 
-
-class Defects:
-    def __init__(self,csv_file):
-        self.csv_file = csv_file
-        
-        self.image_data = []
-
-        self.read_csv()
-
-    def read_csv(self):
-        with open(self.csv_file, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                timestamp, image_defects = self.read_csv_row(row)
-                self.image_data.append((timestamp, image_defects))
-
-    def read_csv_row(self, row):
-        image_timestamp = row["Date Time"]
-        defects = []
-        defect_buffer = []
-
-        # Loop through all columns *after* the first
-        for key in list(row.keys())[1:]:
-            val = row[key].strip()
-            val = None if val == "" else val
-
-            defect_buffer.append(val)
-
-            # Every 3 values = one defect (x, y, z)
-            if len(defect_buffer) == 3:
-                # If all 3 are None → ignore this defect
-                if any(v is not None for v in defect_buffer):
-                    defects.append(tuple(defect_buffer))
-                defect_buffer = []
-        return image_timestamp, defects
+def find_previous_output(input_dir, data_dir_parent):
+    """Newest earlier output made from input_dir, so it can be updated instead of rebuilt."""
+    outputs = sorted(glob.glob(os.path.join(data_dir_parent, os.path.basename(input_dir)+"_output_*")), reverse=True)
+    for data_dir in outputs:
+        if Manifest(data_dir).source == os.path.abspath(input_dir):
+            return data_dir
+    return None
+
+
+class DefectTable:
+    """
+    The whole defects export as NumPy columns, one entry per defect:
+    image (row of the export = tile index), defect (position in the row), u, v, recess.
+    Empty and "- - -" cells are NaN, defects with all three values missing are dropped.
+    positions holds the robot X, Y, Z of each row for a sheet export, None otherwise.
+    """
+    def __init__(self, timestamps, values, positions=None):
+        self.timestamps = np.asarray(timestamps)
+        self.positions = positions
+        n_rows = values.shape[0]
+        n_defects = values.shape[1] // 3
+        triples = values[:, :n_defects * 3].reshape(n_rows, n_defects, 3)
+
+        keep = ~np.isnan(triples).all(axis=2)
+        self.image, self.defect = np.nonzero(keep)
+        self.u, self.v, self.recess = triples[keep].T
+        # np.nonzero walks row by row so image is sorted, each tile is one contiguous slice
+        self.bounds = np.searchsorted(self.image, np.arange(n_rows + 1))
+
+    @classmethod
+    def read(cls, path):
+        """Read a converted .csv or a raw 3DInspect .txt export."""
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+        if path.lower().endswith(".txt"):
+            delimiter = "\t"
+            start = next((i + 1 for i, line in enumerate(lines) if line.startswith("Date Time")), len(lines))
+        else:
+            delimiter = ","
+            start = 1
+        header = lines[start - 1].split(delimiter) if start > 0 and start <= len(lines) else []
+        return cls.from_lines(lines[start:], delimiter, pre_process_data.position_columns(header))
+
+    @classmethod
+    def from_lines(cls, lines, delimiter=",", skip=0):
+        """Parse export rows, the skip columns after the timestamp are robot positions."""
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return cls([], np.empty((0, 0)))
+
+        # Rows can be ragged where trailing empty cells were stripped, pad them out
+        counts = [line.count(delimiter) for line in lines]
+        width = max(counts)
+        if min(counts) != width:
+            lines = [line + (delimiter + "nan") * (width - n) for line, n in zip(lines, counts)]
+
+        timestamps = [line.split(delimiter, 1)[0].strip() for line in lines]
+        if width == 0:
+            return cls(timestamps, np.empty((len(lines), 0)))
+
+        # Blank and "- - -" cells become nan in one pass over the text, then NumPy's C parser does the rest
+        text = "\n".join(lines).replace("- - -", "nan")
+        sep = re.escape(delimiter)
+        text = re.sub(rf"(?<={sep}) *(?={sep}|$)", "nan", text, flags=re.M)
+        values = np.loadtxt(io.StringIO(text), delimiter=delimiter, usecols=range(1, width + 1), ndmin=2, dtype=np.float64)
+        if skip:
+            return cls(timestamps, values[:, skip:], values[:, :skip])
+        return cls(timestamps, values)
+
+    def __len__(self):
+        return len(self.image)
+
+    @property
+    def num_images(self):
+        return len(self.timestamps)
+
+    def rows(self, image):
+        """Slice of the columns belonging to one tile."""
+        if image >= self.num_images:
+            return slice(0, 0)
+        return slice(self.bounds[image], self.bounds[image + 1])
+
+    def points(self, image):
+        """(u, v) of every defect on a tile that has both coordinates."""
+        rows = self.rows(image)
+        uv = np.column_stack((self.u[rows], self.v[rows]))
+        return uv[~np.isnan(uv).any(axis=1)]
+
+    def counts(self):
+        """Number of defects on each tile."""
+        return np.bincount(self.image, minlength=self.num_images)
 
 
 class ConvertImages:
-    def __init__(self, raw_dir, exp_type, csv_file=None):
+    def __init__(self, raw_dir, exp_type, csv_file=None, workers=CONVERT_WORKERS, manifest=None):
         self.raw_dir = raw_dir
         self.exp_type = exp_type
+        self.workers = max(1, workers or 1)
+        self.manifest = manifest
         
         if self.exp_type == "annotated":
             self.csv_file = csv_file
-            defects = Defects(self.csv_file)
-            self.image_defects = defects.image_data
+            self.defect_table = DefectTable.read(self.csv_file)
 
         self.create_exp_dir()
         self.convert_iamges()
@@ -97,27 +167,23 @@ class ConvertImages:
         self.exp_dir = os.path.abspath(self.raw_dir).replace("raw", self.exp_type)
         os.makedirs(self.exp_dir, exist_ok=True)
 
-        for img in os.listdir(self.raw_dir):
-            self.raw_path = os.path.join(self.raw_dir, img)
-            self.exp_path = os.path.join(self.exp_dir, img)
-            shutil.copy(self.raw_path, self.exp_path)
-
-    def get_col_range(self):
+    def get_col_range(self, images):
         mins = []
         maxs = []
-        for img in self.conv_images:
-            img_32 = cv2.imread(img, cv2.IMREAD_UNCHANGED)
+        for img in images:
+            img_32 = tile_cache.read(img)
             img_32 = np.nan_to_num(img_32, nan=np.nanmin(img_32))
             mins.append(np.min(img_32))
             maxs.append(np.max(img_32))
-        min_mean = np.mean(mins)
-        max_mean = np.mean(maxs)
+        min_mean = np.mean(mins) if mins else None
+        max_mean = np.mean(maxs) if maxs else None
                    
         self.col_range = (min_mean, max_mean)
-        self.col_range = (-10.0, 0.0)
+        self.col_range = COL_RANGE
         # self.col_range = (-20.0, 30.0)
 
-    def bit16_to_bit8_col(self, img_32, range=None, color=True):
+    @staticmethod
+    def bit16_to_bit8_col(img_32, range=None, color=True):
         if not range:
             img_8 = cv2.normalize(img_32, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
         else:
@@ -130,29 +196,52 @@ class ConvertImages:
         return img_8_col
 
     def convert_iamges(self):
-        self.conv_images = glob.glob(os.path.join(self.exp_dir, "*.tiff"))
-        self.get_col_range()
+        # Read the raw tiles through the shared cache and write straight to exp_dir,
+        # rather than copying them over and decoding the copies again
+        # Scan order: the scanner names tiles by timestamp, same order stream_ingest adds them in
+        self.raw_images = sorted(glob.glob(os.path.join(self.raw_dir, "*.tiff")), key = os.path.basename)
+        self.conv_images = [os.path.join(self.exp_dir, os.path.basename(img)) for img in self.raw_images]
+
+        # A tile is only converted again if its raw data, defects or the colour range changed
+        self.tile_keys = []
+        todo = []
         for i in range(len(self.conv_images)):
-            img_32 = cv2.imread(self.conv_images[i], cv2.IMREAD_UNCHANGED)
-            # img_32 = np.nan_to_num(img_32, nan=0)
-            # img_32 = np.nan_to_num(img_32, nan=np.nanmin(img_32))
-            img_8 = self.bit16_to_bit8_col(img_32, range=self.col_range, color=False)# range=self.col_range)
-
-            if self.exp_type == "annotated":
-                for defect in self.image_defects[i][1]:
-                    self.annotate_img(img_8, defect)
-
-            # print(i)
-            # if (i + 1) % 5 != 0:
-            #     img_8 = cv2.rotate(img_8, cv2.ROTATE_180)
-            # else:
-            #     # print("True")
-            #     img_8 = cv2.flip(img_8, 1)
-            # img_8 = cv2.rotate(img_8, cv2.ROTATE_180)
-            cv2.imwrite(self.conv_images[i], img_8)
-
-
-    def annotate_img(self,img,defect):
+            defects = self.defect_table.points(i) if self.exp_type == "annotated" else np.empty((0, 2))
+            if self.manifest:
+                key = hash_values(self.manifest.file_hash(self.raw_images[i]), COL_RANGE, defects.tolist())
+                if self.manifest.is_fresh(self.tile_stage(i), key):
+                    self.tile_keys.append(key)
+                    continue
+            else:
+                key = None
+            self.tile_keys.append(key)
+            todo.append((i, defects))
+
+        if not todo:
+            return
+        self.get_col_range([self.raw_images[i] for i, _ in todo])
+
+        jobs = [(tile_cache.read(self.raw_images[i]), self.conv_images[i], self.col_range, defects) for i, defects in todo]
+
+        if self.workers == 1 or len(jobs) < 2:
+            for job in jobs:
+                tile_cache.put(job[1], convert_tile(*job))
+        else:
+            # executor.map yields in submission order, so conv_images keeps the order get_img_grid expects
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as executor:
+                for job, img_8 in zip(jobs, executor.map(convert_tile, *zip(*jobs))):
+                    tile_cache.put(job[1], img_8)
+
+        if self.manifest:
+            for i, _ in todo:
+                self.manifest.record(self.tile_stage(i), self.tile_keys[i], [self.conv_images[i]])
+        print(f"{self.exp_type}: converted {len(todo)} of {len(self.conv_images)} tiles")
+
+    def tile_stage(self, i):
+        return f"{self.exp_type}/{os.path.basename(self.raw_images[i])}"
+
+    @staticmethod
+    def annotate_img(img,defect):
         h, w = img.shape[:2]
         if defect[0] is not None and defect[1] is not None:
             coord = (int(w-float(defect[0])), int(h-float(defect[1])))
@@ -161,7 +250,28 @@ class ConvertImages:
         if coord:
             cv2.circle(img, coord, 20, (0,0,255), 5)
 
-def get_img_grid(grid_size, images):
+def convert_tile(img_32, exp_path, col_range, defects):
+    """Clip, scale, annotate and write one tile. Module level so worker processes can pickle it."""
+    # img_32 = np.nan_to_num(img_32, nan=0)
+    # img_32 = np.nan_to_num(img_32, nan=np.nanmin(img_32))
+    img_8 = ConvertImages.bit16_to_bit8_col(img_32, range=col_range, color=False)# range=self.col_range)
+
+    for defect in defects:
+        ConvertImages.annotate_img(img_8, defect)
+
+    # if (i + 1) % 5 != 0:
+    #     img_8 = cv2.rotate(img_8, cv2.ROTATE_180)
+    # else:
+    #     # print("True")
+    #     img_8 = cv2.flip(img_8, 1)
+    # img_8 = cv2.rotate(img_8, cv2.ROTATE_180)
+    cv2.imwrite(exp_path, img_8)
+    return img_8
+
+def get_img_grid(grid_size, images, cells=None):
+    """(path, row, col) per image. cells gives the grid cell of each image in scan order, default column major."""
+    if cells:
+        return [(path, r, c) for path, (r, c) in zip(images, cells)]
     img_grid = []
     index = 0
     for c in range(grid_size[1]):
@@ -171,6 +281,61 @@ def get_img_grid(grid_size, images):
                 index += 1
     return img_grid
 
+class GridIndex:
+    """
+    Lookups per grid cell, built once per load: which tile is there, the robot coordinate it was
+    taken at and the defects found on it. Tile index i is the i-th entry of img_grid, which is
+    also row i of the defects export.
+    """
+    def __init__(self, grid_size, img_grid, camera_grid, defect_table=None):
+        self.grid_size = grid_size
+        self.camera_grid = camera_grid
+        self.defect_table = defect_table
+
+        self.tile_index = np.full(grid_size, -1, dtype=np.int64)
+        self.cells = {}  # tile filename -> (row, col), shared by the raw/unannotated/annotated copies
+        for i, (path, r, c) in enumerate(img_grid):
+            self.tile_index[r, c] = i
+            self.cells[os.path.basename(path)] = (r, c)
+
+        self.defect_counts = np.zeros(grid_size, dtype=np.int64)
+        if defect_table is not None:
+            counts = defect_table.counts()[:len(img_grid)]
+            filled = self.tile_index >= 0
+            in_table = filled & (self.tile_index < len(counts))
+            self.defect_counts[in_table] = counts[self.tile_index[in_table]]
+
+    def cell_at(self, x, y, width, height):
+        """(row, col) under pixel x, y of the stitched image drawn at width x height, or None."""
+        num_r, num_c = self.grid_size
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+        r = int(y * num_r // height)
+        c = int(x * num_c // width)
+        if self.tile_index[r, c] < 0:
+            return None
+        return r, c
+
+    def tile(self, r, c):
+        return int(self.tile_index[r, c])
+
+    def coord(self, r, c):
+        return (self.camera_grid[0][r], self.camera_grid[1][c])
+
+    def cell_of(self, path):
+        return self.cells.get(os.path.basename(path))
+
+    def defects(self, r, c):
+        """(u, v, recess) rows for the defects found on the tile in this cell."""
+        if self.defect_table is None or self.tile(r, c) < 0:
+            return np.empty((0, 3))
+        rows = self.defect_table.rows(self.tile(r, c))
+        return np.column_stack((self.defect_table.u[rows], self.defect_table.v[rows], self.defect_table.recess[rows]))
+
+    def defect_count(self, r, c):
+        return int(self.defect_counts[r, c])
+
+
 def resize_with_crop_or_pad(img, target_w, target_h):
     h, w = img.shape[:2]
 
@@ -204,38 +369,60 @@ def resize_with_crop_or_pad(img, target_w, target_h):
 
     return img
 
-def stitch_imgs(grid_size, img_grid, img_dir):
-    img_00 = cv2.imread(img_grid[0][0], cv2.IMREAD_UNCHANGED)
+def stitch_imgs(grid_size, img_grid, img_dir, make_pyramid=False):
+    img_00 = tile_cache.read(img_grid[0][0])
     img_h, img_w = img_00.shape[0:2]
     num_r, num_c = grid_size
     img_tot_h = num_r * img_h
     img_tot_w = num_c * img_w
 
-    if len(img_00.shape) == 2:  # grayscale
-        img_stitch = np.zeros((num_r * img_h, num_c * img_w), dtype=img_00.dtype)
-    else:  # multi-channel
-        img_stitch = np.zeros((num_r * img_h, num_c * img_w, img_00.shape[2]), dtype=img_00.dtype)
+    # The canvas lives in a file next to the output rather than in RAM, each tile is copied
+    # straight in as it is read so only one decoded tile is held here at a time
+    canvas_shape = (img_tot_h, img_tot_w) + img_00.shape[2:]
+    canvas_file = tempfile.NamedTemporaryFile(dir=img_dir, suffix=".canvas", delete=False)
+    canvas_file.close()
+    img_stitch = np.memmap(canvas_file.name, dtype=img_00.dtype, mode="w+", shape=canvas_shape)
+    del img_00
+
+    try:
+        for img_path, r, c in img_grid:
+            img = tile_cache.read(img_path)
+            img = resize_with_crop_or_pad(img, img_w, img_h)
+            y1 = r * img_h
+            y2 = y1 + img_h
+            x1 = c * img_w
+            x2 = x1 + img_w
+            img_stitch[y1:y2, x1:x2] = img
+            del img
+
+        dest_path = os.path.join(img_dir, "image_stitched.png")
+        cv2.imwrite(dest_path, img_stitch)
+        if make_pyramid:
+            pyramid.write_pyramid(img_stitch, dest_path)
+    finally:
+        # The memmap has to be released before Windows will let the file go
+        del img_stitch
+        os.remove(canvas_file.name)
 
-    images = {}
-    for img_path, r, c in img_grid:
-        img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-        img = resize_with_crop_or_pad(img, img_w, img_h)
-        images[(r,c)] = img
+    return dest_path
 
-    for (r, c), img in images.items():
-        y1 = r * img_h
-        y2 = y1 + img_h
-        x1 = c * img_w
-        x2 = x1 + img_w
-        img_stitch[y1:y2, x1:x2] = img
 
+def stitch_stage(manifest, name, grid_size, img_grid, tile_keys, img_dir, make_pyramid=False):
+    """stitch_imgs, skipped when the tiles and their grid positions are the same as last time."""
+    key = hash_values(grid_size, [(k, r, c) for k, (_, r, c) in zip(tile_keys, img_grid)], make_pyramid)
     dest_path = os.path.join(img_dir, "image_stitched.png")
-    cv2.imwrite(dest_path, img_stitch)
-
+    if manifest.is_fresh(name, key):
+        return dest_path
+
+    dest_path = stitch_imgs(grid_size, img_grid, img_dir, make_pyramid=make_pyramid)
+    outputs = [dest_path]
+    if make_pyramid:
+        outputs.append(os.path.join(pyramid.pyramid_dir(dest_path), pyramid.METADATA))
+    manifest.record(name, key, outputs)
     return dest_path
 
 
-def main(input_dir):
+def main(input_dir, workers=CONVERT_WORKERS):
     global sheet_dimensions
     global camera_grid
     global grid_size
@@ -245,6 +432,7 @@ def main(input_dir):
     global img_raw_stitched
     global img_unann_stitched
     global img_ann_stitched
+    global grid_index
 
     data_dir = create_save_dir(input_dir)
     
@@ -252,24 +440,50 @@ def main(input_dir):
     camera_coords.sort(key = lambda x: x[1])
     grid_size, num_rows, num_cols, camera_grid = get_grid_info(camera_coords)
 
+    # Every sheet is moved into the same working directory, start it afresh when the next one arrives
+    if os.path.basename(input_dir) == "temp" and pre_process_data.is_new_sheet(input_dir, data_dir, num_rows * num_cols):
+        print(f"New sheet in {input_dir}, clearing {data_dir}")
+        pre_process_data.reset_dir(data_dir)
+    manifest = Manifest(data_dir)
+    manifest.source = os.path.abspath(input_dir)
+
+    # The .txt export is read directly, no intermediate CSV
     if os.path.basename(input_dir) == "temp":
         csv_file = pre_process_data.main(input_dir, data_dir, "move")
     else:
         csv_file = pre_process_data.main(input_dir, data_dir, "copy")
+    if not csv_file:
+        # Nothing new in temp, keep using the export moved over last time
+        sheet_export = os.path.join(data_dir, pre_process_data.SHEET_EXPORT_NAME)
+        exports = glob.glob(os.path.join(data_dir, "*.txt"))
+        if os.path.exists(sheet_export):
+            csv_file = sheet_export
+        else:
+            csv_file = max(exports, key = os.path.getmtime) if exports else None
     img_raw_dir = os.path.join(data_dir, "raw")
-    unannotated_images = ConvertImages(img_raw_dir, "unannotated")
+    unannotated_images = ConvertImages(img_raw_dir, "unannotated", workers=workers, manifest=manifest)
     if csv_file:
-        annotated_images = ConvertImages(img_raw_dir, "annotated", csv_file=csv_file)
+        annotated_images = ConvertImages(img_raw_dir, "annotated", csv_file=csv_file, workers=workers, manifest=manifest)
     else:
         annotated_images = unannotated_images
 
-    images_raw = glob.glob(os.path.join(img_raw_dir, "*.tiff"))
+    images_raw = unannotated_images.raw_images
+    raw_keys = [manifest.file_hash(img) for img in images_raw]
+
+    # Tiles scanned in another order than raster carry their grid cells in the scan plan
+    cells = pre_process_data.read_scan_plan(data_dir)
+    img_raw_grid = get_img_grid(grid_size, images_raw, cells)
+    img_unann_grid = get_img_grid(grid_size, unannotated_images.conv_images, cells)
+    img_ann_grid = get_img_grid(grid_size, annotated_images.conv_images, cells)
+
+    img_raw_stitched = stitch_stage(manifest, "stitch/raw", grid_size, img_raw_grid, raw_keys, img_raw_dir)
+    img_unann_stitched = stitch_stage(manifest, "stitch/unannotated", grid_size, img_unann_grid, unannotated_images.tile_keys, unannotated_images.exp_dir, make_pyramid=True)
+    img_ann_stitched = stitch_stage(manifest, "stitch/annotated", grid_size, img_ann_grid, annotated_images.tile_keys, annotated_images.exp_dir, make_pyramid=True)
 
-    img_raw_grid = get_img_grid(grid_size, images_raw)
-    img_unann_grid = get_img_grid(grid_size, unannotated_images.conv_images)
-    img_ann_grid = get_img_grid(grid_size, annotated_images.conv_images)
+    grid_index = GridIndex(grid_size, img_unann_grid, camera_grid, getattr(annotated_images, "defect_table", None))
 
-    img_raw_stitched = stitch_imgs(grid_size, img_raw_grid, img_raw_dir)
-    img_unann_stitched = stitch_imgs(grid_size, img_unann_grid, unannotated_images.exp_dir)
-    img_ann_stitched = stitch_imgs(grid_size, img_ann_grid, annotated_images.exp_dir)
+    # Tiles worth scanning again, python smart_scan.py <data_dir> makes the RAPID module for them
+    smart_scan.save_rescan(getattr(annotated_images, "defect_table", None), data_dir)
 
+    manifest.save()
+    print(tile_cache)
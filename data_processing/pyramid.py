@@ -0,0 +1,144 @@
+"""
+Tiled image pyramid written next to image_stitched.png.
+
+Level 0 is full resolution and every level after it is half the size of the one before, each
+cut into TILE_SIZE square tiles saved as <level>/<row>_<col>.png with a pyramid.json alongside.
+The viewer asks Pyramid for the tiles covering what it is about to display instead of
+resampling the whole stitched image.
+"""
+
+import os
+import json
+import math
+import shutil
+import cv2
+import numpy as np
+
+TILE_SIZE = 256
+METADATA = "pyramid.json"
+
+
+def pyramid_dir(stitched_path):
+    return os.path.splitext(stitched_path)[0] + "_pyramid"
+
+
+def write_pyramid(img, stitched_path, tile_size=TILE_SIZE):
+    """Cut img (the array that was saved to stitched_path) into a pyramid. Returns the pyramid directory.
+    img is read one band of tile_size rows at a time and every level is built from the bands of the
+    one before, so only a couple of bands per level are ever in memory (img can be a memmap)."""
+    out_dir = pyramid_dir(stitched_path)
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    full_h, full_w = img.shape[0:2]
+    levels = [[full_w, full_h]]
+    while levels[-1][0] > tile_size or levels[-1][1] > tile_size:
+        w, h = levels[-1]
+        levels.append([max(1, w // 2), max(1, h // 2)])
+
+    bands = (img[y:y + tile_size] for y in range(0, full_h, tile_size))
+    for level, size in enumerate(levels):
+        if level:
+            bands = half_bands(bands, size, tile_size)
+        level_dir = os.path.join(out_dir, str(level))
+        os.makedirs(level_dir)
+        bands = write_tiles(bands, level_dir, tile_size)
+    # Pull the bands through every level
+    for _ in bands:
+        pass
+
+    # Written last so a half written pyramid is never picked up
+    with open(os.path.join(out_dir, METADATA), "w") as f:
+        json.dump({"width": full_w, "height": full_h, "tile_size": tile_size, "levels": levels}, f)
+    return out_dir
+
+
+def write_tiles(bands, level_dir, tile_size):
+    """Save each band of a level as its row of tiles, passing the bands on to the next level."""
+    for r, band in enumerate(bands):
+        for c in range(math.ceil(band.shape[1] / tile_size)):
+            cv2.imwrite(os.path.join(level_dir, f"{r}_{c}.png"), band[:, c * tile_size:(c + 1) * tile_size])
+        yield band
+
+
+def half_bands(bands, size, tile_size):
+    """Bands of tile_size rows of the level of size (w, h), from the bands of the level twice its size."""
+    w, h = size
+    halves = []
+    rows = 0
+    for band in bands:
+        # Two source rows per row, so halving each band on its own gives the same rows as halving the
+        # whole level. The odd last row of the level above is dropped, unless it is the only one.
+        if len(band) < 2 and h > 1:
+            continue
+        half_h = max(1, len(band) // 2)
+        halves.append(cv2.resize(band[:2 * half_h], (w, half_h), interpolation=cv2.INTER_AREA))
+        rows += half_h
+        if rows >= tile_size:
+            yield np.concatenate(halves)
+            halves = []
+            rows = 0
+    if halves:
+        yield np.concatenate(halves)
+
+
+class Pyramid:
+    def __init__(self, out_dir):
+        self.dir = out_dir
+        with open(os.path.join(out_dir, METADATA), "r") as f:
+            meta = json.load(f)
+        self.width = meta["width"]
+        self.height = meta["height"]
+        self.tile_size = meta["tile_size"]
+        self.levels = meta["levels"]  # [width, height] per level
+
+    @classmethod
+    def open(cls, stitched_path):
+        """The pyramid for stitched_path, or None if there isn't one or it is older than the image."""
+        out_dir = pyramid_dir(stitched_path)
+        meta_path = os.path.join(out_dir, METADATA)
+        if not os.path.exists(meta_path):
+            return None
+        if os.path.exists(stitched_path) and os.path.getmtime(stitched_path) > os.path.getmtime(meta_path):
+            return None
+        return cls(out_dir)
+
+    def level_for(self, scale):
+        """Smallest level that still has at least `scale` (display px / full res px) of the full resolution."""
+        for level in range(len(self.levels) - 1, -1, -1):
+            if self.levels[level][0] >= self.width * scale and self.levels[level][1] >= self.height * scale:
+                return level
+        return 0
+
+    def tiles(self, viewport, display_size):
+        """
+        Tiles needed to draw viewport = (x0, y0, x1, y1) in full resolution pixels at display_size = (w, h).
+        Returns (level, [(path, (x, y)), ...]) with x, y the tile's top left corner in level pixels.
+        """
+        x0, y0, x1, y1 = viewport
+        scale = min(display_size[0] / max(1, x1 - x0), display_size[1] / max(1, y1 - y0))
+        level = self.level_for(scale)
+        level_w, level_h = self.levels[level]
+        fx = level_w / self.width
+        fy = level_h / self.height
+
+        c0 = max(0, int(x0 * fx) // self.tile_size)
+        r0 = max(0, int(y0 * fy) // self.tile_size)
+        c1 = min(math.ceil(level_w / self.tile_size), math.ceil(x1 * fx / self.tile_size))
+        r1 = min(math.ceil(level_h / self.tile_size), math.ceil(y1 * fy / self.tile_size))
+
+        tiles = []
+        for r in range(r0, r1):
+            for c in range(c0, c1):
+                path = os.path.join(self.dir, str(level), f"{r}_{c}.png")
+                tiles.append((path, (c * self.tile_size, r * self.tile_size)))
+        return level, tiles
+
+    def level_viewport(self, level, viewport):
+        """Convert a full resolution viewport into the pixel coordinates of level."""
+        level_w, level_h = self.levels[level]
+        fx = level_w / self.width
+        fy = level_h / self.height
+        x0, y0, x1, y1 = viewport
+        return (x0 * fx, y0 * fy, x1 * fx, y1 * fy)
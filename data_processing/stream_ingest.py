@@ -0,0 +1,263 @@
+"""
+Streaming version of process_data_v3.main for a sheet that is still being scanned.
+
+Polls the temp directory, moves each finished .tiff into working/raw, converts it and drops it
+into the stitched mosaics straight away. Rows appended to the defects .txt export are picked up
+as they appear and the matching tiles are re-annotated.
+"""
+
+import os
+import sys
+import time
+import shutil
+import cv2
+import numpy as np
+
+import process_data_v3
+import pre_process_data
+from process_data_v3 import DefectTable, convert_tile, resize_with_crop_or_pad
+from tile_cache import tile_cache
+
+POLL_INTERVAL = 0.5  # seconds between directory scans when run from the command line
+ROW_WAIT = 10.0      # seconds after the last tile to wait for defect rows still missing
+
+
+class Mosaic:
+    """A stitched image that is filled in one tile at a time."""
+    def __init__(self, grid_size, img_dir):
+        self.grid_size = grid_size
+        self.path = os.path.join(img_dir, "image_stitched.png")
+        self.canvas = None
+        self.dirty = False
+
+    def place(self, img, r, c):
+        if self.canvas is None:
+            self.tile_h, self.tile_w = img.shape[0:2]
+            num_r, num_c = self.grid_size
+            self.canvas = np.zeros((num_r * self.tile_h, num_c * self.tile_w) + img.shape[2:], dtype=img.dtype)
+
+        img = resize_with_crop_or_pad(img, self.tile_w, self.tile_h)
+        y1 = r * self.tile_h
+        x1 = c * self.tile_w
+        self.canvas[y1:y1 + self.tile_h, x1:x1 + self.tile_w] = img
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            cv2.imwrite(self.path, self.canvas)
+            self.dirty = False
+        return self.path
+
+
+class StreamIngest:
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.data_dir = process_data_v3.create_save_dir(temp_dir)
+        self.raw_dir = os.path.join(self.data_dir, "raw")
+        self.unann_dir = self.raw_dir.replace("raw", "unannotated")
+        self.ann_dir = self.raw_dir.replace("raw", "annotated")
+        for d in (self.raw_dir, self.unann_dir, self.ann_dir):
+            os.makedirs(d, exist_ok=True)
+
+        self.sheet_dimensions, camera_coords = process_data_v3.get_camera_coords()
+        camera_coords.sort(key = lambda x: x[1])
+        self.grid_size, _, _, self.camera_grid = process_data_v3.get_grid_info(camera_coords)
+        self.num_tiles = self.grid_size[0] * self.grid_size[1]
+
+        self.col_range = process_data_v3.COL_RANGE
+        self.raw_images = []      # index = arrival order, same as the glob order main() uses
+        self.export_lines = []    # data rows of the defects export, one per tile
+        self.defect_table = DefectTable([], np.empty((0, 0)))
+        self.annotated = set()    # tile indices annotated with their defect row
+        self.cells = None         # grid cell per tile index from the scan plan
+
+        self.pending = {}         # filename -> size seen on the previous poll
+        self.txt_file = None
+        self.txt_offset = 0
+        self.txt_header = None
+        self.last_change = time.perf_counter()  # last new tile or defect row
+
+        self.mosaics = {
+            "raw": Mosaic(self.grid_size, self.raw_dir),
+            "unannotated": Mosaic(self.grid_size, self.unann_dir),
+            "annotated": Mosaic(self.grid_size, self.ann_dir),
+        }
+        # Mosaic a viewer is showing, the only one rewritten per tile. None writes all of them.
+        # Encoding a full sheet mosaic takes ~0.5 s by the end of a sheet, the rest wait for save_all()
+        self.shown = None
+
+    @property
+    def complete(self):
+        """Every tile is in and annotated, or no defect row came for ROW_WAIT after the last tile
+        (no export, or one short of rows). Those tiles stay unannotated."""
+        if len(self.raw_images) < self.num_tiles:
+            return False
+        return len(self.annotated) >= len(self.raw_images) or time.perf_counter() - self.last_change > ROW_WAIT
+
+    def grid_position(self, index):
+        if self.cells and index < len(self.cells):
+            return self.cells[index]
+        # Column major, matching get_img_grid
+        return index % self.grid_size[0], index // self.grid_size[0]
+
+    def poll(self):
+        """Pick up anything new in the temp directory. Returns True if the mosaics changed."""
+        changed = False
+        if self.cells is None:
+            # Written before the first tile arrives, tiles are column major without it
+            self.cells = pre_process_data.read_scan_plan(self.temp_dir)
+        for filename in self.ready_tiffs():
+            changed |= self.add_tile(filename)
+        changed |= self.read_new_rows()
+        if changed:
+            self.last_change = time.perf_counter()
+        for index in range(len(self.raw_images)):
+            if index not in self.annotated and index < self.defect_table.num_images:
+                self.annotate_tile(index)
+                changed = True
+        if changed or self.complete:
+            self.publish()
+        return changed
+
+    def ready_tiffs(self):
+        """Tiffs whose size has not changed since the last poll, i.e. the scanner has finished writing them."""
+        ready = []
+        for entry in sorted(os.scandir(self.temp_dir), key = lambda e: e.name):
+            if not entry.is_file() or not entry.name.lower().endswith(".tiff"):
+                continue
+            size = entry.stat().st_size
+            if size and self.pending.get(entry.name) == size:
+                ready.append(entry.name)
+                del self.pending[entry.name]
+            else:
+                self.pending[entry.name] = size
+        return ready
+
+    def add_tile(self, filename):
+        if len(self.raw_images) >= self.num_tiles:
+            print(f"Ignoring {filename}, the grid is already full.")
+            return False
+
+        raw_path = os.path.join(self.raw_dir, filename)
+        shutil.move(os.path.join(self.temp_dir, filename), raw_path)
+        try:
+            img_32 = tile_cache.read(raw_path)
+        except IOError:
+            # Not a complete tiff yet, put it back and try again next poll
+            shutil.move(raw_path, os.path.join(self.temp_dir, filename))
+            return False
+
+        index = len(self.raw_images)
+        self.raw_images.append(raw_path)
+        r, c = self.grid_position(index)
+        self.mosaics["raw"].place(img_32, r, c)
+
+        unann_path = os.path.join(self.unann_dir, filename)
+        img_8 = convert_tile(img_32, unann_path, self.col_range, [])
+        tile_cache.put(unann_path, img_8)
+        self.mosaics["unannotated"].place(img_8, r, c)
+        # Shown unannotated until its defect row arrives
+        self.mosaics["annotated"].place(img_8, r, c)
+        print(f"Tile {index + 1}/{self.num_tiles} added at ({r}, {c})")
+        return True
+
+    def annotate_tile(self, index):
+        raw_path = self.raw_images[index]
+        ann_path = os.path.join(self.ann_dir, os.path.basename(raw_path))
+        img_8 = convert_tile(tile_cache.read(raw_path), ann_path, self.col_range, self.defect_table.points(index))
+        tile_cache.put(ann_path, img_8)
+        self.mosaics["annotated"].place(img_8, *self.grid_position(index))
+        self.annotated.add(index)
+
+    def read_new_rows(self):
+        """Parse rows appended to the newest .txt export since the last poll."""
+        txt_files = [os.path.join(self.temp_dir, f) for f in os.listdir(self.temp_dir) if f.lower().endswith(".txt")]
+        if not txt_files:
+            return False
+        newest = max(txt_files, key = os.path.getmtime)
+        rows_seen = len(self.export_lines)
+        if newest != self.txt_file:
+            # A fresh export repeats the earlier rows, only rows past the ones already parsed are new
+            self.txt_file = newest
+            self.txt_offset = 0
+            self.txt_header = None
+            self.export_lines = []
+
+        with open(self.txt_file, "r", encoding="utf-8") as f:
+            f.seek(self.txt_offset)
+            while True:
+                line = f.readline()
+                if not line.endswith("\n"):
+                    break  # partial line, still being written
+                self.txt_offset = f.tell()
+                line = line.strip()
+
+                if self.txt_header is None:
+                    if line.startswith("Date Time"):
+                        self.txt_header = [h.strip() for h in line.split("\t")]
+                    continue
+
+                if line:
+                    self.export_lines.append(line)
+
+        # Rows already annotated are unchanged, only more rows than before means anything new
+        if len(self.export_lines) <= rows_seen:
+            return False
+        skip = pre_process_data.position_columns(self.txt_header)
+        self.defect_table = DefectTable.from_lines(self.export_lines, "\t", skip)
+        return True
+
+    def show(self, name):
+        """Follow mosaic name ("raw", "unannotated" or "annotated") from now on, returns its up to date path."""
+        self.shown = name
+        return self.mosaics[name].save()
+
+    def save_all(self):
+        for mosaic in self.mosaics.values():
+            mosaic.save()
+
+    def publish(self):
+        """Write the shown mosaic, all of them once the sheet is complete, and expose them through the
+        same globals process_data_v3.main sets."""
+        if self.shown is None or self.complete:
+            self.save_all()
+        else:
+            self.mosaics[self.shown].save()
+
+        unann = [os.path.join(self.unann_dir, os.path.basename(p)) for p in self.raw_images]
+        # Tiles still waiting for their defect row are only written unannotated
+        ann = [os.path.join(self.ann_dir if index in self.annotated else self.unann_dir, os.path.basename(p))
+               for index, p in enumerate(self.raw_images)]
+
+        process_data_v3.sheet_dimensions = self.sheet_dimensions
+        process_data_v3.camera_grid = self.camera_grid
+        process_data_v3.grid_size = self.grid_size
+        process_data_v3.img_raw_grid = process_data_v3.get_img_grid(self.grid_size, self.raw_images, self.cells)
+        process_data_v3.img_unann_grid = process_data_v3.get_img_grid(self.grid_size, unann, self.cells)
+        process_data_v3.img_ann_grid = process_data_v3.get_img_grid(self.grid_size, ann, self.cells)
+        process_data_v3.img_raw_stitched = self.mosaics["raw"].path
+        process_data_v3.img_unann_stitched = self.mosaics["unannotated"].path
+        process_data_v3.img_ann_stitched = self.mosaics["annotated"].path
+        process_data_v3.grid_index = process_data_v3.GridIndex(
+            self.grid_size, process_data_v3.img_unann_grid, self.camera_grid, self.defect_table)
+
+
+def main(temp_dir):
+    stream = StreamIngest(temp_dir)
+    print(f"Watching {os.path.abspath(temp_dir)} for {stream.num_tiles} tiles... press Ctrl+C to exit...")
+    try:
+        while not stream.complete:
+            stream.poll()
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("\nStopped by User.")
+    stream.save_all()
+    missing = len(stream.raw_images) - len(stream.annotated)
+    if missing:
+        print(f"⚠️ No defect row for {missing} tiles, left unannotated.")
+    print(tile_cache)
+    return stream
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else r'data_output/temp')
@@ -0,0 +1,93 @@
+import os
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB of decoded tiles
+
+
+def read_tile(path):
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError(f"Could not read image: {path}")
+    return img
+
+
+def array_bytes(img):
+    return img.nbytes
+
+
+class TileCache:
+    """LRU cache of decoded tiles, keyed by (path, mtime) so a rewritten file is decoded again.
+    decode(path) reads a file (OpenCV array by default) and nbytes(img) is what it counts against max_bytes.
+
+    Arrays handed out are read-only and shared between callers, copy before editing in place.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, decode=read_tile, nbytes=array_bytes):
+        self.max_bytes = max_bytes
+        self.decode = decode
+        self.nbytes = nbytes
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path):
+        path = os.path.abspath(path)
+        return (path, os.stat(path).st_mtime_ns)
+
+    def read(self, path):
+        key = self.key(path)
+        img = self.tiles.get(key)
+        if img is not None:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return img
+
+        self.misses += 1
+        img = self.decode(path)
+        self.store(key, img)
+        return img
+
+    def put(self, path, img):
+        """Store an image that has just been written to path, so the next read is a hit."""
+        self.store(self.key(path), img)
+
+    def store(self, key, img):
+        self.discard(key[0])
+        if isinstance(img, np.ndarray):
+            img.flags.writeable = False
+        nbytes = self.nbytes(img)
+        if nbytes > self.max_bytes:
+            return
+        self.tiles[key] = img
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            _, old = self.tiles.popitem(last=False)
+            self.size -= self.nbytes(old)
+
+    def discard(self, path):
+        """Drop every cached version of path."""
+        path = os.path.abspath(path)
+        for key in [k for k in self.tiles if k[0] == path]:
+            self.size -= self.nbytes(self.tiles.pop(key))
+
+    def clear(self):
+        self.tiles.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "tiles": len(self.tiles),
+            "bytes": self.size,
+        }
+
+    def __str__(self):
+        s = self.stats()
+        return f"TileCache: {s['hits']} hits, {s['misses']} misses, {s['tiles']} tiles, {s['bytes'] / 1e6:.1f} MB"
+
+
+# Shared by every stage of process_data_v3 so each tile is decoded once per run
+tile_cache = TileCache()
@@ -3,9 +3,12 @@ All units in mm
 x = 900, y = 0 is the bottom centre of the plate, therefore centre of plate is at x = 900 - (635/2) , y = 0
 """
 
+import os
+import glob
 from math import ceil
 from Camera import surface_control, scan_control, Camera
 from config import *
+from tile_order import plan_tiles, distance, ROBOT_SPEED, ROBOT_ACCEL
 
 sheet_h, sheet_l, sheet_z = sheet_dimensions
 sheet_dimensions = [sheet_l, sheet_h, sheet_z] # (y, x, z) --> (x, y, z)
@@ -65,28 +68,41 @@ orientations = {
 scan_area = camera.scan_area
 camera_offset = camera.camera_offset
 
-#Plate positioning and offset calculations
-if camera == surface_control:
-    sheet_x_location = 900-12.5+20 
-elif camera == scan_control:
-    sheet_x_location = 900-12.5+20 #The offset in mm from the robot origin along the x axis
+def sheet_xyz(dimensions):
+    """config.sheet_dimensions order to (x, y, z)"""
+    h, l, z = dimensions
+    return [l, h, z]
 
-sheet_offset = [
-        sheet_x_location - (sheet_dimensions[0]) + sheet_mount_dimensions[0],
-        (-sheet_dimensions[1])/2 + sheet_mount_dimensions[1],
-        sheet_dimensions[2] + sheet_mount_dimensions[2]
-    ]
+def plate_offset(sheet_dimensions, sheet_mount_dimensions, camera):
+    #Plate positioning and offset calculations
+    if camera == surface_control:
+        sheet_x_location = 900-12.5+20 
+    elif camera == scan_control:
+        sheet_x_location = 900-12.5+20 #The offset in mm from the robot origin along the x axis
 
-#Summing camera (inclusive of mount) and plate offsets for tooltip offset
-offset = [0,0,0]
-for index in range(0,len(offset)):
-    offset[index] = (sheet_offset[index] + camera_offset[index])
+    sheet_offset = [
+            sheet_x_location - (sheet_dimensions[0]) + sheet_mount_dimensions[0],
+            (-sheet_dimensions[1])/2 + sheet_mount_dimensions[1],
+            sheet_dimensions[2] + sheet_mount_dimensions[2]
+        ]
 
-def get_coords():
+    #Summing camera (inclusive of mount) and plate offsets for tooltip offset
+    offset = [0,0,0]
+    for index in range(0,len(offset)):
+        offset[index] = (sheet_offset[index] + camera.camera_offset[index])
+    return offset
+
+offset = plate_offset(sheet_dimensions, sheet_mount_dimensions, camera)
+
+def get_coords(sheet_dimensions = sheet_dimensions, sheet_mount_dimensions = sheet_mount_dimensions, camera = camera, scan_mode = SCAN_MODE):
+    """Tile coordinates for a sheet (x, y, z order) on a mount, with the configured sheet and camera by default."""
+    offset = plate_offset(sheet_dimensions, sheet_mount_dimensions, camera)
     if camera == surface_control:
-        return get_surface_coords(sheet_dimensions, scan_area, offset)
+        return get_surface_coords(sheet_dimensions, camera.scan_area, offset)
+    elif camera == scan_control and scan_mode == "continuous":
+        return get_pass_coords(sheet_dimensions, camera.scan_area, offset)
     elif camera == scan_control:
-        return get_scan_coords()
+        return get_scan_coords(sheet_dimensions, offset)
     else:
         raise ValueError("Camera not recognised! Please check coordinate generation function!")
 
@@ -123,32 +139,10 @@ def get_surface_coords(sheet_dimensions, scan_area, offset):
             y_global = y_centre + offset[1]
             coords.append([x_global, y_global, offset[2]])
     
-    # for x in range(1,x_times+1):
-    #     if x % 2 == 0:
-    #         y_range = range(1,y_times+1)
-    #     else:
-    #         y_range = range(y_times, 0, -1)
-        
-    #     for y in y_range:
-    #         #Find the centre of the area on the sheet
-    #         if x == x_times:
-    #             x_centre = (sheet_dimensions[0] - (scan_area[0] / 2))
-    #         else:
-    #             x_centre = (scan_area[0] * x) - edge_to_middle[0]
-            
-    #         if y == y_times:
-    #             y_centre = (sheet_dimensions[1] - (scan_area[1] / 2))
-    #         else:
-    #             y_centre = (scan_area[1] * y) - edge_to_middle[1]
-
-    #         #Transform to global coords
-    #         x_global = x_centre + offset[0]
-    #         y_global = y_centre + offset[1]
-    #         coords.append([x_global, y_global, offset[2]])
-    
+    # Column by column here, the visiting order (serpentine etc.) is chosen in tile_order.plan_tiles
     return coords
 
-def get_scan_coords():
+def get_scan_coords(sheet_dimensions = sheet_dimensions, offset = offset):
     coords = []
 
     y_min = 0
@@ -163,14 +157,46 @@ def get_scan_coords():
     coords.append([x_constant_global,y_max_global,offset[2]])
     return coords
 
-def motion_to_txt(
+def get_pass_coords(sheet_dimensions = sheet_dimensions, scan_area = scan_control.scan_area, offset = offset):
+    """Start and end of every pass along y over the sheet edges, one lane per line width in x, alternating direction."""
+    coords = []
+    lanes = ceil(sheet_dimensions[0] / scan_area[0])
+    for lane in range(lanes):
+        # Lanes are spread evenly, the outer ones touch the sheet edges
+        if lanes == 1:
+            x_centre = sheet_dimensions[0] / 2
+        else:
+            x_centre = scan_area[0] / 2 + lane * (sheet_dimensions[0] - scan_area[0]) / (lanes - 1)
+        ends = [offset[1], sheet_dimensions[1] + offset[1]]
+        if lane % 2:
+            ends.reverse()
+        for y in ends:
+            coords.append([x_centre + offset[0], y, offset[2]])
+    return coords
+
+def scan_speed(spacing = PROFILE_SPACING, rate = PROFILE_RATE):
+    """Pass speed in mm/s that gives one profile every spacing mm at the scanner's profile rate."""
+    speed = spacing * rate
+    if speed > ROBOT_SPEED:
+        print(f"⚠️ Scan speed {speed:.0f} mm/s is above the robot's {ROBOT_SPEED:.0f} mm/s, profiles will be further apart.")
+    return speed
+
+def run_in_distance(speed, run_in = SCAN_RUN_IN):
+    """Distance before and after the sheet, long enough to reach speed before the first profile."""
+    return max(run_in, speed * speed / (2 * ROBOT_ACCEL))
+
+def motion_module(
         do_pulse: bool = False, 
         wait_time: int = 0.4, 
         pulse_pin: str = "ABB_Scalable_IO_0_DO6",
         module_name: str = "Wizard",
         coords: list = None,
-        orientation: str = "parallel"
+        orientation: str = "parallel",
+        camera_type: Camera = camera,
+        ordering: str = TILE_ORDER,
+        scan_mode: str = SCAN_MODE
     ):
+    """The RAPID module for coords as a string. ordering=None keeps coords in the order given (already planned)."""
 
     effector_orientation = orientations[orientation]
     
@@ -181,51 +207,198 @@ def motion_to_txt(
     pulse_out =     f"    PulseDO\\PLength:=0.2,{pulse_pin};\n" if do_pulse else None
     
     if wait_time:
+        # {number} is filled in per target by coords_to_string. READY carries the target number and
+        # each receive reads exactly one fixed size frame from the host (see scanner_control.Crb)
         wait_command = (
             f"    WaitRob \\InPos;\n"
             f"    WaitTime 0.2;\n"
-            f"    SocketSend client_socket \\Str := \"READY\";\n"
-            f"    SocketReceive client_socket \\Str := integer_in \\Time:=600;\n"
+            f"    SocketSend client_socket \\Str := \"READY {{number}}\\0A\";\n"
+            f"    SocketReceive client_socket \\Str := integer_in \\ReadNoOfBytes:={ROBOT_FRAME_SIZE} \\Time:=600;\n"
             )
     else:
         wait_command = None
 
-    location_strings, movement_strings = coords_to_string(camera, const_coords, wait_command, pulse_out, coords=coords)
+    if camera_type == scan_control and scan_mode == "continuous":
+        location_strings, movement_strings = passes_to_string(const_coords, wait_command, pulse_pin, coords=coords)
+    else:
+        location_strings, movement_strings = coords_to_string(camera_type, const_coords, wait_command, pulse_out, coords=coords, ordering=ordering)
+    
+    module = [f"MODULE {module_name}\n", "\n", "".join(location_strings), "\n"]
+    if wait_time: module.append(socket_variables)
+    
+    module.append("  PROC main()\n")
+    if wait_time: module.append(socket_connection)
+    
+    module.append("    SingArea \\Wrist;\n")
+    module.append("".join(movement_strings))
+    module.append("\n")
     
-    module_name = f"MODULE {module_name}\n"
+    if wait_time: module.append(socket_close)
+    module.append("\n")
+    module.append("  ENDPROC\n")
+    module.append("ENDMODULE")
+    return "".join(module)
+
+def loop_modules(
+        do_pulse: bool = False,
+        wait_time: int = 0.4,
+        pulse_pin: str = "ABB_Scalable_IO_0_DO6",
+        module_name: str = "Wizard",
+        coords: list = None,
+        orientation: str = "parallel",
+        chunk_targets: int = MODULE_CHUNK_TARGETS
+    ):
+    """
+    Surface control coords (in visiting order) as position arrays visited by one FOR loop, instead of a
+    robtarget and a move block per target. Orientation and configuration are shared by every target.
+    Returns the main module, followed by one data module ({module_name}_<n>, one array each) per
+    chunk_targets targets when there are more than that. The arrays are global, so every data module
+    has to be loaded into the same task as the main module (see write_modules).
+    """
+    if not coords:
+        raise ValueError("No targets to visit, a RAPID array needs at least one element")
+    const_coords = f"{orientations[orientation]}, {joint_position}, [9E+09, 9E+09, 9E+09, 9E+09, 9E+09, 9E+09]"
+    chunks = [coords[i:i + chunk_targets] for i in range(0, len(coords), chunk_targets)]
+
+    arrays = []
+    for n, chunk in enumerate(chunks):
+        targets = ",\n".join(f"    {str(coordinate)}" for coordinate in chunk)
+        arrays.append(f"CONST pos targets_{n}{{{len(chunk)}}} := [\n{targets}];\n")
+
+    module = [f"MODULE {module_name}\n", "\n", f"VAR robtarget target := [[0, 0, 0], {const_coords}];\n"]
+    if len(chunks) == 1:
+        module.append(arrays[0])
+    module.append("\n")
+    if wait_time: module.append(socket_variables)
+
+    module.append("  PROC main()\n")
+    if wait_time: module.append(socket_connection)
+    module.append("    SingArea \\Wrist;\n")
+    first = 0
+    for n, chunk in enumerate(chunks):
+        module.append(f"    visit targets_{n}, {first};\n")
+        first += len(chunk)
+    module.append("\n")
+    if wait_time: module.append(socket_close)
+    module.append("\n")
+    module.append("  ENDPROC\n")
+
+    # first is the number of the chunk's first target, READY carries the target number as in the unrolled module
+    module.append("\n")
+    module.append("  PROC visit(pos targets{*}, num first)\n")
+    module.append("    FOR i FROM 1 TO Dim(targets, 1) DO\n")
+    module.append("      target.trans := targets{i};\n")
+    module.append("      IF first + i = 1 THEN\n")
+    module.append("        MOVEJ target, vmax, fine, tool0;\n")
+    module.append("      ELSE\n")
+    module.append("        MOVEL target, v500, fine, tool0;\n")
+    module.append("      ENDIF\n")
+    if do_pulse:
+        module.append(f"      PulseDO\\PLength:=0.2,{pulse_pin};\n")
+    if wait_time:
+        module.append("      WaitRob \\InPos;\n")
+        module.append("      WaitTime 0.2;\n")
+        module.append("      SocketSend client_socket \\Str := \"READY \" + NumToStr(first + i - 1, 0) + \"\\0A\";\n")
+        module.append(f"      SocketReceive client_socket \\Str := integer_in \\ReadNoOfBytes:={ROBOT_FRAME_SIZE} \\Time:=600;\n")
+    module.append("    ENDFOR\n")
+    module.append("  ENDPROC\n")
+    module.append("ENDMODULE")
+
+    modules = ["".join(module)]
+    if len(chunks) > 1:
+        for n, array in enumerate(arrays):
+            modules.append(f"MODULE {module_name}_{n}\n\n{array}\nENDMODULE")
+    return modules
+
+def motion_modules(
+        do_pulse: bool = False,
+        wait_time: int = 0.4,
+        pulse_pin: str = "ABB_Scalable_IO_0_DO6",
+        module_name: str = "Wizard",
+        coords: list = None,
+        orientation: str = "parallel",
+        camera_type: Camera = camera,
+        ordering: str = TILE_ORDER,
+        scan_mode: str = SCAN_MODE,
+        layout: str = MODULE_LAYOUT,
+        chunk_targets: int = MODULE_CHUNK_TARGETS
+    ):
+    """The RAPID modules for coords, main module first. "loop" layout for surface control, otherwise one unrolled module."""
+    if not coords:
+        raise ValueError("No coordinates to write a RAPID module for")
+    if layout == "loop" and camera_type == surface_control:
+        if ordering:
+            coords = plan_tiles(coords, ordering).coords
+        return loop_modules(do_pulse, wait_time, pulse_pin, module_name, coords, orientation, chunk_targets)
+    if layout not in ("loop", "unrolled"):
+        raise ValueError(f"Unknown module layout {layout!r}, expected \"unrolled\" or \"loop\"")
+    return [motion_module(do_pulse, wait_time, pulse_pin, module_name, coords, orientation, camera_type, ordering, scan_mode)]
+
+def module_paths(path: str, count: int):
+    """path for the main module, then path with _0, _1... before the extension for the data modules,
+    numbered like the modules they hold (motion_0.modx holds MODULE Wizard_0)."""
+    stem, ext = os.path.splitext(path)
+    return [path] + [f"{stem}_{n}{ext}" for n in range(count - 1)]
+
+def write_modules(modules: list, path: str = "motion.modx"):
+    """
+    Write the modules from motion_modules next to each other, removing data modules left from a longer plan.
+    Returns True if any file changed.
+
+    The main module reads the target arrays of the data modules directly, so load every file written
+    here into the robot task together with the main module (in RobotStudio / on the FlexPendant:
+    Load Module for motion.modx and each motion_<n>.modx), otherwise the program doesn't link.
+    """
+    paths = module_paths(path, len(modules))
+    written = [write_module(module, module_path) for module, module_path in zip(modules, paths)]
+    stem, ext = os.path.splitext(path)
+    for stale in glob.glob(f"{glob.escape(stem)}_*{ext}"):
+        number = stale[len(stem) + 1:len(stale) - len(ext)]
+        if number.isdigit() and stale not in paths:
+            os.remove(stale)
+            written.append(True)
+    return any(written)
+
+def write_module(module: str, path: str = "motion.modx"):
+    """Write a RAPID module, only if it differs from what is already at path. Returns True if written."""
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read() == module:
+                return False
+    # Never leave a half written module for the controller to load
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as motion:
+        motion.write(module)
+    os.replace(tmp_path, path)
+    return True
 
-    with open("motion.modx", "w") as motion:
-        locations = "".join(location_strings)
-        movements = "".join(movement_strings)
-        
-        motion.write(module_name)
-        motion.write("\n")
-        motion.write(locations)
-        motion.write("\n")
-        if wait_time: motion.write(socket_variables)
-        
-        motion.write("  PROC main()\n")
-        if wait_time: motion.write(socket_connection)
-        
-        motion.write("    SingArea \\Wrist;\n")
-        motion.write(movements)
-        motion.write("\n")
-        
-        if wait_time: motion.write(socket_close)
-        motion.write("\n")
-        motion.write("  ENDPROC\n")
-        motion.write("ENDMODULE")
+def motion_to_txt(
+        do_pulse: bool = False, 
+        wait_time: int = 0.4, 
+        pulse_pin: str = "ABB_Scalable_IO_0_DO6",
+        module_name: str = "Wizard",
+        coords: list = None,
+        orientation: str = "parallel",
+        path: str = "motion.modx",
+        ordering: str = TILE_ORDER,
+        scan_mode: str = SCAN_MODE,
+        layout: str = MODULE_LAYOUT
+    ):
+    modules = motion_modules(do_pulse, wait_time, pulse_pin, module_name, coords, orientation,
+                             ordering=ordering, scan_mode=scan_mode, layout=layout)
+    return write_modules(modules, path)
 
-def coords_to_string(camera_type: Camera, const_coords: str, wait_command: str = None, pulse_out: str = None, coords: list = []):
+def coords_to_string(camera_type: Camera, const_coords: str, wait_command: str = None, pulse_out: str = None, coords: list = [], ordering: str = TILE_ORDER):
     
     location_strings = []
     movement_strings = []
     
     #SURFACE CONTROL LOGIC ---------------------------------------------------
-    if camera == surface_control:
+    if camera_type == surface_control:
         
-        #Avoids passing singularity point at robot centre more than once
-        coords.sort(key = lambda x: x[1])
+        #Visiting order from tile_order (raster by default: avoids passing the singularity at robot centre more than once)
+        if ordering:
+            coords[:] = plan_tiles(coords, ordering).coords
         
         for number, coordinate in enumerate(coords):
             location = f"CONST robtarget Josh{str(number)}:= [{str(coordinate)}, {const_coords}];\n"
@@ -239,12 +412,12 @@ def coords_to_string(camera_type: Camera, const_coords: str, wait_command: str =
             if pulse_out:
                 movement_strings.append(pulse_out)
             if wait_command:
-                movement_strings.append(wait_command)
+                movement_strings.append(wait_command.format(number=number))
         
         return location_strings, movement_strings
     
     #SCAN CONTROL LOGIC ---------------------------------------------------------
-    elif camera == scan_control:
+    elif camera_type == scan_control:
         
         for number, coordinate in enumerate(coords):
             
@@ -254,7 +427,7 @@ def coords_to_string(camera_type: Camera, const_coords: str, wait_command: str =
                 
                 movement = f"    MOVEJ Josh{str(number)}, vmax, fine, tool0;\n"
                 if wait_command:
-                    movement_strings.append(wait_command)
+                    movement_strings.append(wait_command.format(number=number))
                 #Pulse out should be after this? ----------------------------------------
             else:
                 movement = f"    MOVEL Josh{str(number)}, v500, fine, tool0;\n"
@@ -265,17 +438,69 @@ def coords_to_string(camera_type: Camera, const_coords: str, wait_command: str =
             if pulse_out:
                 movement_strings.append(pulse_out)
             if wait_command:
-                movement_strings.append(wait_command)
+                movement_strings.append(wait_command.format(number=number))
 
         return location_strings, movement_strings
 
     else:
         raise ValueError("Failed at coords_to_string()")
 
+def passes_to_string(const_coords: str, wait_command: str = None, trigger_output: str = "ABB_Scalable_IO_0_DO6", coords: list = [],
+                     speed: float = None, run_in: float = None, zone: str = SCAN_ZONE):
+    """
+    Continuous line scan: coords are (start, end) pairs of passes over the sheet. Every pass is flown
+    with TriggL at constant speed from run_in before the sheet to run_in after it, and trigger_output
+    is high exactly over the sheet, so the scanner acquires at its full profile rate without stopping.
+    Passes are joined with zone data; with wait_command the robot only stops at the start of a pass
+    for the host's handshake (READY <pass>), each frame from the host releases one pass and a last
+    READY <number of passes> follows the final pass (see scanner_control.Crb.run_passes).
+    """
+    speed = speed or scan_speed()
+    run_in = run_in or run_in_distance(speed)
+
+    location_strings = [
+        f"CONST speeddata v_scan := [{speed:.1f}, 500, 5000, 1000];\n",
+        f"VAR triggdata scan_on;\n",
+        f"VAR triggdata scan_off;\n",
+    ]
+    movement_strings = [
+        # On run_in after the start of the pass, off run_in before its end: over the sheet only
+        f"    TriggIO scan_on, {run_in:.1f} \\Start \\DOp:={trigger_output}, 1;\n",
+        f"    TriggIO scan_off, {run_in:.1f} \\DOp:={trigger_output}, 0;\n",
+    ]
+
+    for number in range(len(coords) // 2):
+        start, end = coords[2 * number], coords[2 * number + 1]
+        length = distance(start, end)
+        direction = [(end[i] - start[i]) / length for i in range(2)] if length else [0, 0]
+        run_in_start = [start[0] - direction[0] * run_in, start[1] - direction[1] * run_in, start[2]]
+        run_out_end = [end[0] + direction[0] * run_in, end[1] + direction[1] * run_in, end[2]]
+
+        location_strings.append(f"CONST robtarget Josh{2 * number}:= [{str(run_in_start)}, {const_coords}];\n")
+        location_strings.append(f"CONST robtarget Josh{2 * number + 1}:= [{str(run_out_end)}, {const_coords}];\n")
+
+        # Stop at the start of the pass only when the host has to release it
+        approach_zone = "fine" if wait_command else zone
+        if number < 1:
+            movement_strings.append(f"    MOVEJ Josh{2 * number}, vmax, {approach_zone}, tool0;\n")
+        else:
+            movement_strings.append(f"    MOVEL Josh{2 * number}, v500, {approach_zone}, tool0;\n")
+        if wait_command:
+            movement_strings.append(wait_command.format(number=number))
+        last = number == len(coords) // 2 - 1
+        movement_strings.append(f"    TriggL Josh{2 * number + 1}, v_scan, scan_on \\T2:=scan_off, {'fine' if last else zone}, tool0;\n")
+
+    if wait_command:
+        # One more READY once the last pass is flown, so the host knows the sheet is done (Crb.run_passes)
+        movement_strings.append(f"    WaitRob \\InPos;\n")
+        movement_strings.append(f"    SocketSend client_socket \\Str := \"READY {len(coords) // 2}\\0A\";\n")
+
+    return location_strings, movement_strings
+
 
 if __name__ == "__main__":
     #Getting co-ordinates and writing to the coordinates.csv
 
-    coords = get_coords()
-    #Fill RAPID file
-    motion_to_txt(coords=coords, module_name=module_name, do_pulse=do_pulses, wait_time=wait_time, orientation=camera.orientation)
\ No newline at end of file
+    #Fill RAPID file from the recipe for this product, rewritten only when it changed
+    from recipes import load_recipe, install_recipe
+    install_recipe(load_recipe())
\ No newline at end of file
@@ -0,0 +1,85 @@
+"""
+Pipelined sheet scan: the robot heads to the next tile while the last one is acknowledged and
+exported.
+
+Per tile the sequential loop in scanner_control does move -> READY -> trigger -> state 5 -> ack
+-> status wait -> export. Once the sensor reaches state 5 the exposure is over, so the robot is
+free to move, but the sensor still has to be acknowledged and back in Ready before the next trigger.
+The orchestrator keeps exactly those two interlocks:
+    - the robot is only sent on once the previous tile's acquisition has reached state 5
+    - a tile is only triggered once the previous tile has been acknowledged and exported
+Blocking driver calls run in worker threads. Modbus is only ever used by one of them at a time,
+the robot socket is used in parallel.
+"""
+
+import time
+import asyncio
+import scanner_control
+from scanner_control import MicroEpsilonDriver, Crb
+
+
+class MeasurementOrchestrator:
+    def __init__(self, driver: MicroEpsilonDriver, robot: Crb):
+        self.driver = driver
+        self.robot = robot
+
+    async def move(self, coords):
+        tracer = self.driver.tracer
+        with tracer.span("phase.robot_go"):
+            await asyncio.to_thread(self.robot.go, coords[0], coords[1], coords[2])
+        with tracer.span("phase.wait_ready"):
+            await asyncio.to_thread(self.robot.wait_ready)
+        if self.driver.settle_time:
+            await asyncio.sleep(self.driver.settle_time)
+
+    async def acquire(self, coords):
+        do_timed_events = self.driver.timed_events()
+        with self.driver.tracer.span("phase.auto_mode"):
+            while not await asyncio.to_thread(self.driver.automatic_mode, do_timed_events):
+                await asyncio.sleep(0.1)
+        await asyncio.to_thread(self.driver.trigger_measurement, do_timed_events)
+
+    async def run(self, coords_list):
+        """Scan every position in coords_list. Returns the sheet time in seconds."""
+        start = time.perf_counter()
+        finishing = None
+        try:
+            for number, coords in enumerate(coords_list):
+                print(f"\n--- TILE {number + 1}/{len(coords_list)} ---")
+                # Robot moves while the previous tile is acknowledged and exported
+                await self.move(coords)
+                if finishing:
+                    # Time spent waiting here is export the robot move didn't hide
+                    with self.driver.tracer.span("phase.finish_wait"):
+                        await finishing
+                    finishing = None
+
+                await self.acquire(coords)
+                finishing = asyncio.create_task(asyncio.to_thread(self.driver.finish_tile, coords))
+
+            if finishing:
+                await finishing
+                finishing = None
+        finally:
+            if finishing:
+                # Don't leave the sensor half acknowledged if the robot side failed
+                await asyncio.gather(finishing, return_exceptions=True)
+
+        sheet_time = time.perf_counter() - start
+        self.driver.tracer.event("sheet", sheet_time, tiles=len(coords_list))
+        print(f"Sheet finished: {len(coords_list)} tiles in {sheet_time:.1f} s")
+        return sheet_time
+
+
+def scan_sheet(driver: MicroEpsilonDriver, robot: Crb, coords_list, continuous = False):
+    """Scan a sheet, the caller writes the sheet export (driver.finish_sheet) afterwards.
+    continuous: coords_list are line scan passes (SCAN_MODE "continuous"), flown without the area sensor."""
+    if continuous:
+        start = time.perf_counter()
+        robot.run_passes(coords_list)
+        return time.perf_counter() - start
+    return asyncio.run(MeasurementOrchestrator(driver, robot).run(coords_list))
+
+
+if __name__ == "__main__":
+    scanner_control.main(scan_sheet)
@@ -0,0 +1,178 @@
+"""
+Scan recipes: everything needed to scan one product, cached by what it was made from.
+
+A recipe is keyed by a hash of the sheet and mount dimensions, the camera (scan area, offsets,
+focal length), the tool orientation, the part number, the tile ordering and the RAPID module
+settings. It holds the tile plan (visiting order and grid cells) and the generated RAPID modules,
+stored as recipes/<part>_<key>.json. Switching back to a known product loads it instead of
+planning again, and the modules are only rewritten when they actually change.
+
+    python recipes.py [part_number]   # load or build the recipe for config, write motion.modx if needed
+    python recipes.py list
+"""
+
+import os
+import sys
+import json
+import hashlib
+import motionplanning
+from tile_order import Plan, plan_tiles, grid_cells, print_plans
+from config import *
+
+RECIPE_VERSION = 4 # bump when coordinate or module generation changes, old recipes are then rebuilt
+CAMERAS = {cam.name: cam for cam in (motionplanning.surface_control, motionplanning.scan_control)}
+
+
+class Recipe:
+    def __init__(self, key, params, plan, modules):
+        self.key = key
+        self.params = params
+        self.plan = plan
+        self.modules = modules  # RAPID modules, main module first (motionplanning.motion_modules)
+
+    @property
+    def coords(self):
+        return self.plan.coords
+
+
+def recipe_params(
+        part = PART_NUMBER,
+        sheet = sheet_dimensions,
+        mount = sheet_mount_dimensions,
+        camera_type = camera,
+        orientation = None,
+        ordering = TILE_ORDER
+        ):
+    """Everything the plan and module depend on, as plain values."""
+    return {
+        "version": RECIPE_VERSION,
+        "part": part,
+        "sheet": list(sheet),
+        "mount": list(mount),
+        "camera": {
+            "name": camera_type.name,
+            "scan_area": list(camera_type.scan_area),
+            "camera_offset": list(camera_type.camera_offset),
+            "focal_length": camera_type.focal_length,
+        },
+        "orientation": orientation or camera_type.orientation,
+        "ordering": ordering,
+        "scan": {
+            "mode": SCAN_MODE,
+            "profile_spacing": PROFILE_SPACING,
+            "profile_rate": PROFILE_RATE,
+            "run_in": SCAN_RUN_IN,
+            "zone": SCAN_ZONE,
+        },
+        "module": {
+            "name": module_name,
+            "do_pulses": do_pulses,
+            "wait_time": wait_time,
+            "socket_ip": socket_ip,
+            "frame_size": ROBOT_FRAME_SIZE,
+            "layout": MODULE_LAYOUT,
+            "chunk_targets": MODULE_CHUNK_TARGETS,
+        },
+    }
+
+
+def recipe_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def recipe_path(params, key, directory = RECIPE_DIR):
+    part = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in str(params["part"]))
+    return os.path.join(directory, f"{part}_{key}.json")
+
+
+def build_recipe(params, key):
+    camera_type = CAMERAS[params["camera"]["name"]]
+    coords = motionplanning.get_coords(motionplanning.sheet_xyz(params["sheet"]), params["mount"], camera_type, params["scan"]["mode"])
+    if camera_type == motionplanning.scan_control:
+        # Line scan targets are (start, end) pairs of passes, their order is the path
+        plan = Plan("passes", coords, grid_cells(coords))
+    else:
+        plan = plan_tiles(coords, params["ordering"])
+    modules = motionplanning.motion_modules(
+        do_pulse=params["module"]["do_pulses"],
+        wait_time=params["module"]["wait_time"],
+        module_name=params["module"]["name"],
+        coords=[list(c) for c in plan.coords],
+        orientation=params["orientation"],
+        camera_type=camera_type,
+        ordering=None,
+        scan_mode=params["scan"]["mode"],
+        layout=params["module"]["layout"],
+        chunk_targets=params["module"]["chunk_targets"],
+    )
+    return Recipe(key, params, plan, modules)
+
+
+def save_recipe(recipe, directory = RECIPE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = recipe_path(recipe.params, recipe.key, directory)
+    data = {
+        "key": recipe.key,
+        "params": recipe.params,
+        "ordering": recipe.plan.ordering,
+        "coords": recipe.plan.coords,
+        "cells": recipe.plan.cells,
+        "modules": recipe.modules,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_recipe(params = None, directory = RECIPE_DIR):
+    """The recipe for params (default: the configured product), from the cache or built and cached."""
+    params = params or recipe_params()
+    key = recipe_key(params)
+    path = recipe_path(params, key, directory)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            plan = Plan(data["ordering"], data["coords"], [tuple(cell) for cell in data["cells"]])
+            return Recipe(key, params, plan, data["modules"])
+        except (ValueError, KeyError, OSError):
+            print(f"Ignoring unreadable recipe {path}")
+    recipe = build_recipe(params, key)
+    save_recipe(recipe, directory)
+    print(f"New recipe {path}")
+    return recipe
+
+
+def install_recipe(recipe, path = "motion.modx"):
+    """Write the recipe's RAPID modules to path (and path_0... for data modules) if they aren't there already.
+    Returns True if anything was written."""
+    written = motionplanning.write_modules(recipe.modules, path)
+    print(f"{path} {'updated' if written else 'unchanged'} (recipe {recipe.params['part']} {recipe.key})")
+    if len(recipe.modules) > 1:
+        print(f"Load the {len(recipe.modules) - 1} data modules next to {path} into the robot task with it")
+    return written
+
+
+def list_recipes(directory = RECIPE_DIR):
+    if not os.path.isdir(directory):
+        return []
+    recipes = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            with open(os.path.join(directory, filename), "r") as f:
+                data = json.load(f)
+            recipes.append((filename, data["params"], len(data["coords"])))
+    return recipes
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "list":
+        for filename, params, tiles in list_recipes():
+            print(f"{filename:<40}{tiles:>5} tiles  sheet {params['sheet']}  {params['camera']['name']}  {params['ordering']}")
+        sys.exit(0)
+    params = recipe_params(part=sys.argv[1]) if len(sys.argv) > 1 else recipe_params()
+    recipe = load_recipe(params)
+    print_plans([recipe.plan])
+    install_recipe(recipe)
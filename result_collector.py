@@ -0,0 +1,200 @@
+"""
+Per tile defect exports without driving the 3DInspect GUI.
+
+Both collectors have the read_status_text / save_defect_file pair that defect_saver provides, so
+the driver uses them in its place (use_collector):
+
+StreamResultCollector    - adds the result the driver read from the sensor data stream for the
+                           tile to a 3DInspect style export. Status comes from the acquisition state.
+DirectoryResultCollector - waits for the file 3DInspect auto exports for the measurement and
+                           adds its row to the export.
+
+Like the exports saved from the 3DInspect GUI, every export holds all tiles so far, one row per tile
+(blank for a tile without a result). It is rewritten under the name requested for each tile and the
+previous one removed, so the export directory only ever holds the newest.
+
+SheetExport replaces the per tile exports altogether: the driver adds each tile's result with its
+robot position and one file for the sheet is written every SHEET_FLUSH_TILES tiles and at the end.
+
+Exports keep the 3DInspect layout ("Date Time" header, tab separated rows) so
+pre_process_data reads them like the ones saved from the GUI.
+"""
+
+import os
+import time
+from datetime import datetime
+from config import RESULT_SOURCE, EXPORT_DIR, AUTO_EXPORT_DIR, SHEET_EXPORT_NAME, SHEET_FLUSH_TILES, POSITION_COLUMNS
+
+EXPORT_PREAMBLE = "www.micro-epsilon.com\n3DInspect\n\n"
+EXPORT_WAIT = 5.0 # s, how long DirectoryResultCollector waits for the auto export
+
+
+def export_header(num_defects):
+    columns = ["Date Time"]
+    names = ("Center u location [px]", "Center v location [px]", "Recess [mm]")
+    for defect in range(num_defects):
+        for i, name in enumerate(names):
+            columns.append(f"Sort defects {defect * 3 + i + 1} (Defect {defect + 1}: {name}) [mm]")
+    return "\t".join(columns)
+
+
+def write_export(path, lines):
+    """Write export rows (Date Time, then the defect fields, tab separated) as a 3DInspect export,
+    replacing path in one step."""
+    num_defects = max((line.count("\t") // 3 for line in lines), default=0)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(EXPORT_PREAMBLE)
+        f.write(export_header(num_defects) + "\n")
+        for line in lines:
+            f.write(line + "\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+def empty_row():
+    """Export row of a tile without a result, keeps the rows after it on their tiles."""
+    return datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+
+
+class CumulativeExport:
+    """Rows of every tile so far, rewritten as one export per tile."""
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.lines = []
+        self.path = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, line, filename):
+        self.lines.append(line)
+        path = write_export(os.path.join(self.out_dir, filename + ".txt"), self.lines)
+        if self.path and self.path != path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = path
+        print(f"Defects saved to {path} ({len(self.lines)} tiles)")
+        return path
+
+
+class StreamResultCollector(CumulativeExport):
+    def __init__(self, driver, out_dir = EXPORT_DIR):
+        super().__init__(out_dir)
+        self.driver = driver
+
+    def read_status_text(self):
+        return "Ready" if self.driver.get_state() == 1 else "Busy"
+
+    def save_defect_file(self, filename = "defects_exported"):
+        result = self.driver.last_result
+        if result is None:
+            print(f"⚠️ No result from the data stream for {filename}, exported as a blank row.")
+            return self.add(empty_row(), filename)
+        return self.add(result.raw.decode("utf-8", errors="replace").rstrip("\r\n"), filename)
+
+
+class DirectoryResultCollector(CumulativeExport):
+    def __init__(self, watch_dir = AUTO_EXPORT_DIR, out_dir = EXPORT_DIR, timeout = EXPORT_WAIT, poll = 0.05):
+        if not watch_dir:
+            raise ValueError("AUTO_EXPORT_DIR has to be set to collect 3DInspect auto exports")
+        super().__init__(out_dir)
+        self.watch_dir = watch_dir
+        self.timeout = timeout
+        self.poll = poll
+        # Anything already there belongs to earlier measurements
+        self.seen = set(os.listdir(watch_dir))
+
+    def read_status_text(self):
+        # The acknowledge already waits for Ready, the export file itself is the signal here
+        return "Ready"
+
+    def new_exports(self):
+        return sorted(name for name in os.listdir(self.watch_dir)
+                      if name.lower().endswith(".txt") and name not in self.seen)
+
+    @staticmethod
+    def read_rows(path):
+        """Data rows of an auto export, the lines after its Date Time header."""
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+        start = next((i + 1 for i, line in enumerate(lines) if line.startswith("Date Time")), len(lines))
+        return [line for line in lines[start:] if line.strip()]
+
+    def save_defect_file(self, filename = "defects_exported"):
+        """Add the row of the next finished auto export to the export, rewritten as out_dir/<filename>.txt.
+        A blank row if none turns up in time."""
+        deadline = time.perf_counter() + self.timeout
+        sizes = {}
+        while time.perf_counter() < deadline:
+            for name in self.new_exports():
+                path = os.path.join(self.watch_dir, name)
+                size = os.path.getsize(path)
+                # Finished once its size holds between two polls
+                if sizes.get(name) == size and size > 0:
+                    self.seen.add(name)
+                    rows = self.read_rows(path)
+                    os.remove(path)
+                    return self.add(rows[-1] if rows else empty_row(), filename)
+                sizes[name] = size
+            time.sleep(self.poll)
+        print(f"⚠️ No auto export appeared in {self.watch_dir} for {filename}, exported as a blank row.")
+        return self.add(empty_row(), filename)
+
+
+class SheetExport:
+    def __init__(self, out_dir = EXPORT_DIR, flush_every = SHEET_FLUSH_TILES, name = SHEET_EXPORT_NAME):
+        self.path = os.path.join(out_dir, name)
+        self.flush_every = flush_every
+        self.rows = []         # (timestamp, (x, y, z), defect fields)
+        self.num_defects = 0
+        self.flushed = 0       # rows in the file on disk
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, result, coords):
+        """Add one tile. result is the tile's DataResult, or None to keep the row for a tile without one."""
+        if result is None:
+            timestamp, fields = empty_row(), []
+        else:
+            line = result.raw.decode("utf-8", errors="replace").rstrip("\r\n")
+            timestamp, _, rest = line.partition("\t")
+            fields = rest.split("\t") if rest else []
+        self.rows.append((timestamp, coords, fields))
+        self.num_defects = max(self.num_defects, len(fields) // 3)
+        if len(self.rows) - self.flushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Rewrite the sheet export with every tile so far, replacing the file in one step."""
+        header = export_header(self.num_defects).split("\t")
+        header[1:1] = POSITION_COLUMNS
+        width = self.num_defects * 3
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(EXPORT_PREAMBLE)
+            f.write("\t".join(header) + "\n")
+            for timestamp, coords, fields in self.rows:
+                position = [f"{value:.3f}" if value is not None else "" for value in coords]
+                f.write("\t".join([timestamp] + position + fields + [""] * (width - len(fields))) + "\n")
+        os.replace(tmp_path, self.path)
+        self.flushed = len(self.rows)
+        print(f"Sheet export: {self.flushed} tiles in {self.path}")
+        return self.path
+
+
+def make_collector(driver, source = RESULT_SOURCE):
+    """Collector for source ("stream", "directory" or "sheet"), None for "gui" (defect_saver)."""
+    if source == "stream":
+        return StreamResultCollector(driver)
+    if source == "directory":
+        return DirectoryResultCollector()
+    if source == "sheet":
+        return SheetExport()
+    if source == "gui":
+        return None
+    raise ValueError(f"Unknown result source {source!r}")
+
+
+def use_collector(driver, collector):
+    if isinstance(collector, SheetExport):
+        driver.sheet_export = collector
+        return
+    driver.read_status_text = collector.read_status_text
+    driver.save_defect_file = collector.save_defect_file
@@ -1,17 +1,39 @@
+import sys
 import time
 import socket
+import threading
+from collections import deque
 from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ModbusException
 from config import *
-from motionplanning import get_coords
-from defect_saver import save_defect_file, read_status_text
+try:
+    from defect_saver import save_defect_file, read_status_text
+except ImportError:
+    # pywinauto is Windows only, without it the export functions have to be given to the driver
+    save_defect_file = read_status_text = None
+from result_collector import make_collector, use_collector
+from tile_order import save_plan, load_plan
+from recipes import load_recipe
+from tracing import NULL_TRACER, Tracer, summarize, print_summary
 
 # --- CONFIGURATION ---
 IP_ADDRESS = '127.0.0.1'
 MODBUS_PORT = 502
 DATA_PORT = 502  # For the TCP data stream
 
+# --- ROBOT PROTOCOL ---
+# Host -> robot: fixed size frames "<seq>,<x>,<y>,<z>" padded with spaces and ending in a newline.
+# RAPID reads exactly ROBOT_FRAME_SIZE bytes per SocketReceive, so frames sent ahead are never merged.
+# Robot -> host: "READY <seq>\n" once it is in position at target <seq>. A bare "READY" from an
+# older module is matched to the oldest target still waiting. Frame size is ROBOT_FRAME_SIZE in config.
+
 class Crb:
     def __init__(self, ip = "192.168.125.1", port = 8000, timeout = 2.0):
+        self.tracer = NULL_TRACER
+        self.seq = 0                  # target number of the next frame
+        self.outstanding = deque()    # targets sent that haven't reported READY yet
+        self.ready_seqs = set()       # READYs that arrived before they were waited for
+        self.rx_buffer = b""
         try:
             self.ip = ip
             self.port = port
@@ -33,6 +55,7 @@ class Crb:
                 self.sock.settimeout(self.timeout)
                 self.sock.connect((self.ip, self.port))
                 self.connected = True
+                self.rx_buffer = b""
                 return True
             except Exception as e:
                 self.connected = False
@@ -42,7 +65,8 @@ class Crb:
     def send(self, message):
         for _ in range(2):
             try:
-                self.sock.sendall(message)
+                with self.tracer.span("robot.send"):
+                    self.sock.sendall(message)
                 print(f"Sent to robot: {message}\n")
                 return True
             except Exception as e:
@@ -50,28 +74,69 @@ class Crb:
                 print(f"Error sending message to robot: {str(e)}")
         return False
 
+    @staticmethod
+    def frame(seq, x = None, y = None, z = None):
+        if x is None:
+            msg = f"{seq}"
+        else:
+            msg = f"{seq},{float(x):.3f},{float(y):.3f},{float(z):.3f}"
+        if len(msg) >= ROBOT_FRAME_SIZE:
+            raise ValueError(f"Robot frame too long: {msg}")
+        return (msg.ljust(ROBOT_FRAME_SIZE - 1) + "\n").encode()
+
+    def next_target(self):
+        """Number the next target. Target 0 is where RAPID goes on connecting, before any frame is read."""
+        seq = self.seq
+        self.seq += 1
+        self.outstanding.append(seq)
+        return seq
+
     def send_coords(self, x, y, z = 140.0):
-        for _ in range(2):
-            try:
-                msg = f"{float(x):.3f},{float(y):.3f},{float(z):.3f}"
-                self.sock.sendall(msg.encode())
-                print(f"Sent to robot: {msg}\n")
-                return True
-            except Exception as e:
-                self.reconnect(max_attempts=2,pause_time=0.2)
-                print(f"Error sending to robot: {str(e)}")
-        return False
-    
+        return self.send_targets([(x, y, z)])
+
+    def send_targets(self, coords_list):
+        """Queue several targets in one send. Returns their sequence numbers, or None if sending failed."""
+        seqs = []
+        frames = b""
+        for coords in coords_list:
+            seq = self.next_target()
+            seqs.append(seq)
+            if seq > 0:
+                frames += self.frame(seq, *coords)
+        if frames and not self.send(frames):
+            return None
+        return seqs
+
     def go(self, x = None, y = None, z = None):
+        """Release the robot to its next target. Returns the target's sequence number."""
         if x and y and z:
-            return self.send_coords(x, y, z)
-        else:
-            return self.send(b"go")
+            seqs = self.send_coords(x, y, z)
+            return seqs[0] if seqs else None
+        seq = self.next_target()
+        if seq > 0 and not self.send(self.frame(seq)):
+            return None
+        return seq
+
+    def run_passes(self, coords_list):
+        """Continuous line scan (motionplanning.passes_to_string): coords_list holds the start and end of
+        every pass. The robot reports READY at the start of each pass and once after the last one, every
+        go releases one pass. The line scanner is gated by the robot's trigger output, not from here."""
+        passes = coords_list[::2]
+        for number, start in enumerate(passes):
+            print(f"\n--- PASS {number + 1}/{len(passes)} ---")
+            with self.tracer.span("pass", x=start[0], y=start[1]):
+                self.go(*start)
+                self.wait_ready()
+        # Release the last pass and wait until it is flown
+        with self.tracer.span("pass"):
+            self.go()
+            self.wait_ready()
 
     def receive(self, attempts = 1):
         for _ in range(attempts):
             try:
-                data = self.sock.recv(1024)
+                with self.tracer.span("robot.recv"):
+                    data = self.sock.recv(1024)
                 if data:
                     return data
                 else:
@@ -81,17 +146,51 @@ class Crb:
                 time.sleep(0.2)
         return None
 
-    def wait_ready(self, ready_signal = b'READY'):
-        while True:
+    def read_messages(self, attempts = 20):
+        """Complete newline terminated messages received so far. A bare READY without a newline
+        (older RAPID modules) is taken as a whole message as well."""
+        data = self.receive(attempts)
+        if data:
+            self.rx_buffer += data
+        *messages, self.rx_buffer = self.rx_buffer.split(b"\n")
+        if self.rx_buffer.strip() == b"READY":
+            messages.append(self.rx_buffer)
+            self.rx_buffer = b""
+        return [m.decode("utf-8", errors="replace").strip() for m in messages if m.strip()]
+
+    def mark_ready(self, message):
+        parts = message.split()
+        if parts[0] != "READY" or len(parts) > 2 or (len(parts) > 1 and not parts[1].isdigit()):
+            print(f"Unexpected message from robot: {message}")
+            return
+        if len(parts) > 1:
+            seq = int(parts[1])
+        elif self.outstanding:
+            seq = self.outstanding[0]
+        else:
+            print("READY received with no target outstanding.")
+            return
+        if seq in self.outstanding:
+            self.outstanding.remove(seq)
+        self.ready_seqs.add(seq)
+
+    def wait_ready(self, seq = None):
+        """Block until target seq (default: the oldest outstanding target) reports READY.
+        Returns False without waiting if no target is outstanding."""
+        if seq is None:
+            if not self.outstanding:
+                print("⚠️ wait_ready with no target outstanding, call go() first.")
+                return False
+            seq = self.outstanding[0]
+        while seq not in self.ready_seqs:
             try:
-                data = self.receive(attempts = 20)
-                if data and ready_signal in data:
-                    print(data.decode("utf-8"))
-                    print("Robot READY signal recieved.")
-                    return True
+                for message in self.read_messages():
+                    self.mark_ready(message)
             except socket.timeout:
                 print("Waiting for Robot READY signal... press Ctrl+C to exit...")
-                
+        self.ready_seqs.discard(seq)
+        print(f"Robot READY signal recieved for target {seq}.")
+        return True
 
     def close(self):
         try:
@@ -105,70 +204,285 @@ class Crb:
 REG_CONTROL_SMART = 3   # Register 4 in manual (Smart Control)
 # Input Registers (Inputs from Sensor)
 REG_STATUS_ACQ    = 1   # Register 2 in manual (IB_StateAcquisition)
+REG_RESULTS       = 2   # Registers 3-8 in manual: measurement counter, then the inspection program's results
+REG_RESULT_COUNT  = 6
+REG_INPUT_BLOCK   = 0   # Status and result registers are read together, starting here
+REG_INPUT_COUNT   = 8   # ...this many of them in one request
 
 # --- CONTROL BITS (Register 4) ---
 BIT_AUTO_MODE  = 1   # Bit 0: Q_AutomaticMode (Value 1)
 BIT_START      = 2   # Bit 1: Q_Start (Value 2)
 BIT_RESULT_ACK = 8   # Bit 3: Q_ResultsAck (Value 8)
 
+# --- STATE POLLING ---
+# wait_for_state starts polling quickly and backs off, so short transitions are seen almost
+# immediately without hammering Modbus during a long exposure. Transitions that repeat every tile
+# (exposure, acknowledge) first sleep through EXPECT_FRACTION of the shortest of their last
+# EXPECT_HISTORY durations, so polling only starts once the state is about to change
+POLL_MIN     = 0.005 # s, first poll interval
+POLL_MAX     = 0.1   # s, longest poll interval
+POLL_BACKOFF = 1.5   # interval multiplier after every poll that didn't match
+EXPECT_FRACTION = 0.95
+EXPECT_HISTORY  = 5
+TRANSITION_HISTORY = 1000 # newest transitions kept in MicroEpsilonDriver.transitions
+
+# --- DATA STREAM ---
+# One result per measurement, a line in the layout of a 3DInspect export row:
+# "<Date Time>\t<u>\t<v>\t<recess>\t<u>\t<v>\t<recess>...\r\n" (blank fields for no value).
+# DataStreamReader drains the port on its own thread so results are never left in the kernel
+# buffer or cut off at a recv boundary, and keeps the newest DATA_BUFFER_FRAMES of them.
+DATA_BUFFER_FRAMES = 64
+DATA_MAX_FRAME     = 1024 * 1024 # bytes, a partial frame longer than this is dropped
+DATA_WAIT          = 0.5         # s, how long trigger_measurement waits for the result after state 5,
+                                   # and beyond the usual acquisition time before it polls the state
+
+class DataResult:
+    def __init__(self, raw: bytes, received: float):
+        self.raw = raw
+        self.received = received
+        fields = raw.decode("utf-8", errors="replace").rstrip("\r\n").split("\t")
+        self.timestamp = fields[0]
+        self.defects = []  # (u, v, recess), None where a value was blank
+        values = [float(value) if value.strip() not in ("", "- - -") else None for value in fields[1:]]
+        for i in range(0, len(values) - 2, 3):
+            self.defects.append(tuple(values[i:i + 3]))
+
+    def __repr__(self):
+        return f"DataResult({self.timestamp!r}, {len(self.defects)} defects)"
+
+
+class DataStreamReader:
+    def __init__(self, sock: socket.socket, max_frames = DATA_BUFFER_FRAMES, max_frame = DATA_MAX_FRAME):
+        self.sock = sock
+        self.max_frame = max_frame
+        self.frames = deque(maxlen=max_frames)
+        self.dropped = 0      # frames pushed out of the full ring buffer or over max_frame
+        self.buffer = b""
+        self.ready = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.sock.settimeout(0.2)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="data-stream", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1.0)
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data:
+                print("⚠️ Data stream closed by sensor.")
+                break
+            self.feed(data)
+        self.running = False
+
+    def feed(self, data: bytes):
+        """Add received bytes and queue every frame they complete."""
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        if len(self.buffer) > self.max_frame:
+            self.buffer = b""
+            self.dropped += 1
+        received = time.time()
+        with self.ready:
+            for line in lines:
+                if not line.strip():
+                    continue
+                if len(self.frames) == self.frames.maxlen:
+                    self.dropped += 1
+                self.frames.append(DataResult(line, received))
+            self.ready.notify_all()
+
+    def get(self, timeout = 0.0):
+        """Oldest result not yet taken, waiting up to timeout for one. None if there isn't one."""
+        with self.ready:
+            if not self.frames and timeout > 0:
+                self.ready.wait_for(lambda: self.frames or not self.running, timeout)
+            return self.frames.popleft() if self.frames else None
+
+    def clear(self):
+        """Drop every result not yet taken. Returns how many there were."""
+        with self.ready:
+            count = len(self.frames)
+            self.frames.clear()
+            return count
+
+
+# --- MODBUS ACCESS ---
+# Every state poll reads the status and result registers as one block (REG_INPUT_BLOCK), so the
+# results of a measurement come with the poll that saw state 5. A dropped link is reconnected
+# and the request repeated up to MODBUS_RETRIES times before giving up.
+MODBUS_RETRIES     = 3
+MODBUS_RETRY_DELAY = 0.1   # s, doubled after every failed attempt
+
+class ModbusRegisters:
+    def __init__(self, ip, port = MODBUS_PORT, retries = MODBUS_RETRIES):
+        self.client = ModbusTcpClient(ip, port=port)
+        self.retries = retries
+        self.round_trips = 0
+        self.reconnects = 0
+
+    def connect(self):
+        return self.client.connect()
+
+    def request(self, method, *args, **kwargs):
+        """Run one client request, reconnecting and retrying if the link or the request fails."""
+        delay = MODBUS_RETRY_DELAY
+        for attempt in range(self.retries + 1):
+            try:
+                self.round_trips += 1
+                rr = method(*args, **kwargs)
+                if not rr.isError():
+                    return rr
+                print(f"⚠️ Modbus error response: {rr}")
+            except (ModbusException, OSError) as e:
+                print(f"⚠️ Modbus request failed ({e}), reconnecting...")
+                self.client.close()
+                time.sleep(delay)
+                delay *= 2
+                self.reconnects += 1
+                self.client.connect()
+        raise ConnectionError(f"Modbus request failed after {self.retries + 1} attempts")
+
+    def read_inputs(self, address, count):
+        """count input registers from address, in one request."""
+        return self.request(self.client.read_input_registers, address, count=count).registers
+
+    def read_input(self, address):
+        return self.read_inputs(address, 1)[0]
+
+    def write(self, address, value):
+        self.request(self.client.write_register, address, value)
+
+    def close(self):
+        self.client.close()
+
+
 class MicroEpsilonDriver:
-    def __init__(self, ip):
-        self.mb = ModbusTcpClient(ip, port=MODBUS_PORT)
+    def __init__(self, ip, modbus_port = MODBUS_PORT, data_port = DATA_PORT):
+        self.registers = ModbusRegisters(ip, port=modbus_port)
         self.sock = None
+        self.reader = None
         self.ip = ip
+        self.modbus_port = modbus_port
+        self.data_port = data_port
+        self.tracer = NULL_TRACER
         self.timer = time.time()
+        # Settle time between the robot reporting READY and triggering. RAPID already waits
+        # 0.2 s after WaitRob \InPos before sending READY, so no extra wait by default
+        self.settle_time = 0.0
+        # (from_state, to_state, seconds) for the last TRANSITION_HISTORY wait_for_state calls, newest last
+        self.transitions = deque(maxlen=TRANSITION_HISTORY)
+        # Recent durations per expected transition ("state_5", "ack"...), see wait_for_state
+        self.durations = {}
+        # Input registers from the last state poll, REG_INPUT_BLOCK onwards
+        self.input_block = None
+        # Result registers from the poll that saw state 5, first one is the measurement counter
+        self.result_registers = None
+        # Set once the data stream has delivered a result, see trigger_measurement
+        self.stream_results = False
+        self.last_result = None     # DataResult of the latest measurement
+        # 3DInspect status/export, replaceable when running without the GUI (simulator, benchmark)
+        self.read_status_text = read_status_text
+        self.save_defect_file = save_defect_file
+        # result_collector.SheetExport when results are written once per sheet instead of per tile
+        self.sheet_export = None
 
     def connect(self):
-        if not self.mb.connect():
-            raise ConnectionError("Could not connect to Modbus (Port 502).")
+        if not self.registers.connect():
+            raise ConnectionError(f"Could not connect to Modbus (Port {self.modbus_port}).")
         print("✅ Modbus Connected.")
         
         # Connect to Data Stream
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.settimeout(5.0)
-            self.sock.connect((self.ip, DATA_PORT))
+            self.sock.connect((self.ip, self.data_port))
+            self.reader = DataStreamReader(self.sock)
+            self.reader.start()
             print("✅ TCP Data Stream Connected.")
         except Exception as e:
-            print(f"⚠️ Could not connect to Data Port {DATA_PORT}: {e}")
+            print(f"⚠️ Could not connect to Data Port {self.data_port}: {e}")
 
     def get_state(self):
-        """Reads Input Register 2 to get current State Machine status."""
-        # unit=1 or slave=1 depending on pymodbus version
-        rr = self.mb.read_input_registers(REG_STATUS_ACQ)
-        if rr.isError():
-            # Fallback for older pymodbus
-            rr = self.mb.read_input_registers(REG_STATUS_ACQ)
-            if rr.isError(): return -1
-        
+        """Reads Input Register 2 to get current State Machine status, with the rest of the input block."""
+        try:
+            with self.tracer.span("modbus.read_state"):
+                self.input_block = self.registers.read_inputs(REG_INPUT_BLOCK, REG_INPUT_COUNT)
+            value = self.input_block[REG_STATUS_ACQ - REG_INPUT_BLOCK]
+        except ConnectionError as e:
+            print(f"❌ {e}")
+            return -1
+
         # High byte is UserSet, Low byte is`` StateAcquisition
         # We mask 0xFF to get just the Low`` 
         #"1111111111111qaByte (State)
-        return rr.registers[0] & 0xFF
+        return value & 0xFF
 
     def set_control_register(self, value):
         """Writes to Holding Register 4."""
-        self.mb.write_register(REG_CONTROL_SMART, value)
+        with self.tracer.span("modbus.write_control", value=value):
+            self.registers.write(REG_CONTROL_SMART, value)
 
-    def get_data(self, blocking = False):
-        try:
-            if blocking:
-                self.sock.setblocking(True)
-            else:
-                self.sock.setblocking(False)
-            
-            data = self.sock.recv(4096)  # Adjust buffer size as needed
-            if data:
-                print(f"Received {len(data)} bytes of data.")
-                print(data.decode("utf-8"))
-                return data
-            else:
-                print("No data received.")
-                return None
-        except Exception as e:
+    def get_data(self, timeout = 0.0):
+        """Next result from the data stream as a DataResult, waiting up to timeout. None if there is none."""
+        if not self.reader:
             return None
+        with self.tracer.span("data.wait"):
+            result = self.reader.get(timeout)
+        if result:
+            print(f"Received {len(result.raw)} bytes of data, {len(result.defects)} defects.")
+        else:
+            print("No data received.")
+        return result
 
     
+    def wait_for_state(self, target, timeout = 2.0, do_timed_events: bool = False, expect = None):
+        """
+        Poll the acquisition state until it matches target (a state, a collection of states or a
+        predicate). Polling starts at POLL_MIN and backs off to POLL_MAX. Returns the state reached,
+        or None on timeout. The time each transition took is appended to self.transitions.
+        expect names a transition that repeats every tile: polling starts after most of its usual duration.
+        """
+        if callable(target):
+            matches = target
+        elif isinstance(target, int):
+            matches = lambda state: state == target
+        else:
+            matches = lambda state: state in target
+
+        start = time.perf_counter()
+        interval = POLL_MIN
+        history = self.durations.setdefault(expect, deque(maxlen=EXPECT_HISTORY)) if expect else None
+        if history:
+            time.sleep(min(min(history) * EXPECT_FRACTION, timeout))
+        first_state = state = self.get_state()
+        while not matches(state):
+            elapsed = time.perf_counter() - start
+            if elapsed >= timeout:
+                self.transitions.append((first_state, None, elapsed))
+                return None
+            time.sleep(min(interval, timeout - elapsed))
+            interval = min(interval * POLL_BACKOFF, POLL_MAX)
+            state = self.get_state()
+            if do_timed_events: print(f"   State: {state}")
+
+        self.transitions.append((first_state, state, time.perf_counter() - start))
+        if history is not None:
+            history.append(time.perf_counter() - start)
+        return state
+
     def automatic_mode(self, do_timed_events: bool = False):
         # 1. Automatic mode ON - REG 4 write 1
         current_state = self.get_state()
@@ -180,106 +494,146 @@ class MicroEpsilonDriver:
             self.set_control_register(BIT_AUTO_MODE)
             
             # Wait for State 1 (Ready)
-            for _ in range(10):
-                time.sleep(0.2)
-                state = self.get_state()
-                if do_timed_events: print(f"   State: {state}")
-                if state == 1: break
-            else:
+            if self.wait_for_state(1, timeout=2.0, do_timed_events=do_timed_events, expect="auto_mode") is None:
                 print("❌ Timeout waiting for Ready State (1)")
                 return False
 
-        if self.get_state() != 1:
+        elif current_state != 1:
             print("❌ Sensor not Ready. Check connections.")
             return False
 
         print("✅ Sensor is READY (State 1).")
         return True    
 
-    def trigger_measurement(self, do_timed_events: bool = False):
+    def trigger_measurement(self, do_timed_events: bool = False, timeout = 10.0):
+        # Results still queued belong to earlier measurements (late or unclaimed), never to this one
+        if self.reader:
+            stale = self.reader.clear()
+            if stale:
+                print(f"⚠️ Discarded {stale} stale result(s) from the data stream.")
+
         # 2. TRIGGER MEASUREMENT
-        #time.sleep(0.5)
-        
         print(">> Triggering Scan (Sending 3)...")
-        self.set_control_register(BIT_AUTO_MODE | BIT_START)
+        with self.tracer.span("phase.trigger"):
+            self.set_control_register(BIT_AUTO_MODE | BIT_START)
 
         # 3. WAIT FOR PROCESSING
         # State sequence: 1 -> 2 (Exposure) -> 3/4 (Processing) -> 5 (Wait for Acknowledgement)
-        processing_timer = time.time()
-        
         print(">> Waiting for completion...")
-        data_received = False
-        for _ in range(20):
-            state = self.get_state()
-            if do_timed_events: print(f"   State: {state}")
+        # State 5 means "I have data, please acknowledge"
+        data = None
+        with self.tracer.span("phase.state_5"):
+            if self.stream_results:
+                # The result arriving on the stream marks the end of the acquisition, so wait for
+                # it instead of polling through the exposure, then confirm with a single read.
+                # Only for about the usual acquisition time: a missing frame falls back to polling
+                history = self.durations.setdefault("state_5", deque(maxlen=EXPECT_HISTORY))
+                start = time.perf_counter()
+                data = self.get_data(min((max(history) if history else 0.0) + DATA_WAIT, timeout))
+                if data is not None:
+                    history.append(time.perf_counter() - start)
+                self.stream_results = data is not None
+                reached = self.wait_for_state(5, timeout=max(timeout - (time.perf_counter() - start), 0.0),
+                                              do_timed_events=do_timed_events)
+            else:
+                # Nothing to poll for during the exposure, start shortly before it usually ends
+                reached = self.wait_for_state(5, timeout=timeout, do_timed_events=do_timed_events, expect="state_5")
+        if reached is None:
+            print("❌ Timeout waiting for results (State 5)")
+            self.result_registers = None
+        else:
+            # Same block as the poll that saw state 5, no extra request
+            first = REG_RESULTS - REG_INPUT_BLOCK
+            self.result_registers = self.input_block[first:first + REG_RESULT_COUNT]
+            print(f"Result registers: {self.result_registers}")
+
+        if data is None:
+            data = self.get_data(DATA_WAIT if reached is not None else 0.0)
+            # Once results have been seen on the stream, later tiles can wait on it
+            self.stream_results = data is not None
+        self.last_result = data
+        return data is not None
+
+    def acknowledge(self, attempts = 3):
+        for _ in range(attempts):
+            print(">> Acknowledging Results (Sending 9)...")
+            self.set_control_register(BIT_AUTO_MODE | BIT_RESULT_ACK)
+            acked_state = self.wait_for_state(lambda state: state != 5, timeout=1.0, expect="ack")
             
-            # State 5 means "I have data, please acknowledge"
-            if state == 5: 
-                break
-    
-            # # While waiting, check for TCP data
-            if not data_received  and time.time() - processing_timer > 1.0:
-                data = self.get_data()
-                data_received = data is not None
-
-            time.sleep(0.2)
-        
-        if not data_received:
-                data = self.get_data()
-                data_received = data is not None
-        
-
-    def acknowledge(self):
-        print(">> Acknowledging Results (Sending 9)...")
-        self.set_control_register(BIT_AUTO_MODE | BIT_RESULT_ACK)
-        time.sleep(0.2)
-        
-        # 5. RESET TO READY
-        # Go back to just AutoMode(1) -> Value 1
-        print(">> Resetting to Ready (Sending 1)...")
-        self.set_control_register(BIT_AUTO_MODE)
-        time.sleep(0.2)
-        
-        final_state = self.get_state()
-        print(f"Final Sensor State: {final_state} (Should be 1)")
-        if final_state != 1:
+            # 5. RESET TO READY
+            # Go back to just AutoMode(1) -> Value 1
+            print(">> Resetting to Ready (Sending 1)...")
+            self.set_control_register(BIT_AUTO_MODE)
+            # Clearing the acknowledge bit doesn't change the state, no need to read it again if it is Ready
+            final_state = 1 if acked_state == 1 else self.wait_for_state(1, timeout=1.0, expect="ready")
+            
+            print(f"Final Sensor State: {final_state} (Should be 1)")
+            if final_state == 1:
+                return True
             print("❌ Sensor not in Ready State after acknowledgment.")
-            self.acknowledge()
+        return False
     
-    def run_measurement_cycle(self, robot: Crb, coords: list = [None, None, None]):
-        print("\n--- STARTING MEASUREMENT CYCLE ---")
-        
+    def timed_events(self):
         # Timed events are console outputs, stops spam in console
         if time.time() - self.timer > 3:
             self.timer = time.time()
-            do_timed_events = True
-        else:
-            do_timed_events = False
+            return True
+        return False
 
-        # 1. SWITCH SCANNER TO AUTOMATIC MODE
-        if not self.automatic_mode(do_timed_events):
-            return self.run_measurement_cycle(robot, coords)
-        # 5. SEND GO SIGNAL TO ROBOT
-        robot.go(coords[0],coords[1],coords[2])
-        
-        # 2. WAIT FOR ROBOT TO BE READY (STATIONARY WAITING FOR NEXT MOVE)
-        robot.wait_ready()
-        time.sleep(0.3)
-        # 3. TRIGGER SCANNER MEASUREMENT
-        self.trigger_measurement(do_timed_events)
+    def finish_tile(self, coords: list = [None, None, None]):
+        """Acknowledge the results of the last measurement and export its defects file."""
         # 4. ACKNOWLEDGE RESULTS
-        self.acknowledge()
+        with self.tracer.span("phase.ack", x=coords[0], y=coords[1]):
+            self.acknowledge()
+
+        if self.sheet_export:
+            # Kept in memory and written once per sheet, nothing to wait for in 3DInspect
+            with self.tracer.span("phase.export", x=coords[0], y=coords[1]):
+                self.sheet_export.add(self.last_result, coords)
+            return
         
         #This is a weird hack and read_status_text() should be replaced eventually
-        while ("Ready" not in read_status_text()):
-            print("Waiting for sensor to return to Ready state...")
-            time.sleep(0.5)
+        with self.tracer.span("phase.status_wait", x=coords[0], y=coords[1]):
+            while ("Ready" not in (self.read_status_text() or "")):
+                print("Waiting for sensor to return to Ready state...")
+                time.sleep(0.5)
         
-        save_defect_file(filename = f"Defects_{time.time()}_{coords[0]}_{coords[1]}")
-        time.sleep(0.2)
+        with self.tracer.span("phase.export", x=coords[0], y=coords[1]):
+            self.save_defect_file(filename = f"Defects_{time.time()}_{coords[0]}_{coords[1]}")
+
+    def finish_sheet(self):
+        """Write out the sheet export (if results are collected per sheet) after the last tile."""
+        if self.sheet_export:
+            with self.tracer.span("phase.sheet_export"):
+                self.sheet_export.flush()
+
+    def run_measurement_cycle(self, robot: Crb, coords: list = [None, None, None]):
+        print("\n--- STARTING MEASUREMENT CYCLE ---")
+        do_timed_events = self.timed_events()
+
+        with self.tracer.span("cycle", x=coords[0], y=coords[1]):
+            # 1. SWITCH SCANNER TO AUTOMATIC MODE
+            with self.tracer.span("phase.auto_mode"):
+                ready = self.automatic_mode(do_timed_events)
+            if not ready:
+                return self.run_measurement_cycle(robot, coords)
+            # 5. SEND GO SIGNAL TO ROBOT
+            with self.tracer.span("phase.robot_go"):
+                robot.go(coords[0],coords[1],coords[2])
+            
+            # 2. WAIT FOR ROBOT TO BE READY (STATIONARY WAITING FOR NEXT MOVE)
+            with self.tracer.span("phase.wait_ready"):
+                robot.wait_ready()
+            if self.settle_time:
+                time.sleep(self.settle_time)
+            # 3. TRIGGER SCANNER MEASUREMENT
+            self.trigger_measurement(do_timed_events)
+            # 4. ACKNOWLEDGE RESULTS AND EXPORT
+            self.finish_tile(coords)
 
     def close(self, robot: Crb = None): 
-        self.mb.close()
+        self.registers.close()
+        if self.reader: self.reader.stop()
         if self.sock: self.sock.close()
         if robot: robot.close()
 
@@ -300,30 +654,55 @@ def input_coords():
 def shutdown():
     pass
 
-if __name__ == "__main__":   
-    # Get coordinates to scan
-    coords = get_coords()
-    coords.sort(key = lambda x: x[1])
+def scan_loop(driver, crb, coords):
+    """Sequential scan, one full measurement cycle per tile."""
+    for position in coords:
+        driver.run_measurement_cycle(crb, position)
+
+
+def main(scan = scan_loop):
+    """Scan the configured sheet with scan(driver, crb, coords), sequential by default (orchestrator passes
+    its pipelined scan_sheet). Tile plan of the configured product, cached in recipes/, or the rescan of a
+    processed sheet: python scanner_control.py rescan <output dir> (see smart_scan)"""
+    if len(sys.argv) > 2 and sys.argv[1] == "rescan":
+        from smart_scan import RESCAN_PLAN_NAME
+        plan = load_plan(sys.argv[2], RESCAN_PLAN_NAME)
+        if plan is None:
+            sys.exit(f"No {RESCAN_PLAN_NAME} in {sys.argv[2]}")
+    else:
+        plan = load_recipe().plan
+    coords = plan.coords
+    if camera == scan_control and SCAN_MODE == "continuous":
+        # Fly-by line scan: the robot is stepped once per pass and the area sensor isn't used
+        crb = Crb()
+        crb.run_passes(coords)
+        crb.close()
+        return
+    # Tile -> grid cell mapping for stitching, next to the tiles and exports
+    save_plan(plan, EXPORT_DIR)
 
     # Initialize Driver connection
     driver = MicroEpsilonDriver(IP_ADDRESS)
     driver.connect()
+    collector = make_collector(driver)
+    if collector:
+        use_collector(driver, collector)
 
     # Initialize robot connection
     crb = Crb()
-    for position in coords:
-        try:
-            driver.run_measurement_cycle(crb, position)
 
-        except KeyboardInterrupt:
-            print("\nStopped by User.")
-            break
-            shutdown()
-
-        except Exception as e:
-            print(f"CRITICAL ERROR: {e}")
-            break
-            shutdown()
+    # One trace file per sheet, summarise with: python tracing.py traces/<file>.jsonl
+    tracer = Tracer.for_sheet()
+    driver.tracer = crb.tracer = tracer
+    try:
+        scan(driver, crb, coords)
+    except KeyboardInterrupt:
+        print("\nStopped by User.")
+    except Exception as e:
+        print(f"CRITICAL ERROR: {e}")
+    finally:
+        # Tiles scanned before a failure are still written to the sheet export
+        driver.finish_sheet()
 
     try:
         driver.exit_to_manual_mode()
@@ -331,4 +710,10 @@ if __name__ == "__main__":
         pass
     driver.close()
     crb.close()
-    print("🔌 Connection Closed.")
\ No newline at end of file
+    tracer.close()
+    print_summary(summarize(tracer.path))
+    print("🔌 Connection Closed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Local stand-ins for the hardware scanner_control talks to, so cycle timing can be worked on
+without the cell.
+
+RobotSimulator   - the RAPID socket server generated by motionplanning.motion_to_txt: sends
+                   "READY 0" once at the first target, then for every frame it reads moves for
+                   move_time and answers "READY <n>".
+SensorSimulator  - the Micro-Epsilon Modbus TCP interface (state register, control register)
+                   and its TCP data stream. Writing the control register walks the acquisition
+                   state machine 150 -> 1 -> 2 -> 3 -> 4 -> 5 with the configured latencies, and a
+                   result line is pushed to every data stream client on reaching state 5 (and
+                   written to export_dir as a 3DInspect auto export if one is given).
+InspectSimulator - the 3DInspect status label and File -> Export that defect_saver drives through
+                   the GUI, with the time each of those takes.
+
+Both run on background threads and bind to 127.0.0.1 on a free port unless told otherwise:
+
+    with RobotSimulator() as robot, SensorSimulator() as sensor:
+        crb = Crb(robot.host, robot.port)
+        driver = MicroEpsilonDriver(sensor.host, modbus_port=sensor.modbus_port, data_port=sensor.data_port)
+        inspect = InspectSimulator(sensor)
+        driver.read_status_text = inspect.read_status_text
+        driver.save_defect_file = inspect.save_defect_file
+"""
+
+import os
+import time
+import struct
+import socket
+import threading
+from datetime import datetime
+from config import (ROBOT_FRAME_SIZE, REG_CONTROL_SMART, REG_STATUS_ACQ, REG_RESULTS,
+                    BIT_AUTO_MODE, BIT_START, BIT_RESULT_ACK)
+from result_collector import EXPORT_PREAMBLE, export_header
+
+# Acquisition states (IB_StateAcquisition)
+STATE_MANUAL     = 150
+STATE_READY      = 1
+STATE_EXPOSURE   = 2
+STATE_PROCESSING = 3
+STATE_EVALUATING = 4
+STATE_RESULTS    = 5
+
+NUM_REGISTERS = 32
+
+
+def serve_socket(host, port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(5)
+    server.settimeout(0.2)
+    return server
+
+
+def recv_exactly(conn, size, running):
+    data = b""
+    while len(data) < size and running():
+        try:
+            chunk = conn.recv(size - len(data))
+        except socket.timeout:
+            continue
+        if not chunk:
+            return None
+        data += chunk
+    return data if len(data) == size else None
+
+
+class RobotSimulator:
+    def __init__(self, host = "127.0.0.1", port = 0, move_time = 0.5, settle_time = 0.2, travel = None):
+        self.host = host
+        self.move_time = move_time
+        self.travel = travel            # (from_xyz, to_xyz) -> seconds, replaces move_time when given
+        self.settle_time = settle_time  # RAPID's WaitTime after WaitRob \InPos
+        self.server = serve_socket(host, port)
+        self.port = self.server.getsockname()[1]
+        self.frames = []                # every frame received, decoded and stripped
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="robot-sim", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=2)
+        self.server.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve(self):
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(0.2)
+            with conn:
+                self.run_program(conn)
+
+    def run_program(self, conn):
+        # MOVEJ to the first target straight after SocketAccept, then one target per frame
+        target = 0
+        position = None
+        time.sleep(self.move_time + self.settle_time)
+        conn.sendall(f"READY {target}\n".encode())
+        while self.running:
+            frame = recv_exactly(conn, ROBOT_FRAME_SIZE, lambda: self.running)
+            if frame is None:
+                return
+            self.frames.append(frame.decode().strip())
+            target += 1
+            # A frame with only the target number (go() without coordinates) keeps the robot where it is
+            coords = self.frames[-1].split(",")[1:4]
+            goal = [float(v) for v in coords] if len(coords) == 3 else position
+            if self.travel and position:
+                time.sleep(self.travel(position, goal) + self.settle_time)
+            else:
+                time.sleep(self.move_time + self.settle_time)
+            position = goal
+            conn.sendall(f"READY {target}\n".encode())
+
+
+class SensorSimulator:
+    def __init__(
+            self,
+            host = "127.0.0.1",
+            modbus_port = 0,
+            data_port = 0,
+            auto_mode_time = 0.1,
+            exposure_time = 0.3,
+            processing_time = 0.2,
+            evaluation_time = 0.1,
+            ack_time = 0.05,
+            defects_per_tile = 3,
+            export_dir = None
+            ):
+        self.host = host
+        self.auto_mode_time = auto_mode_time
+        self.exposure_time = exposure_time
+        self.processing_time = processing_time
+        self.evaluation_time = evaluation_time
+        self.ack_time = ack_time
+        self.defects_per_tile = defects_per_tile
+        self.export_dir = export_dir
+
+        self.input_registers = [0] * NUM_REGISTERS
+        self.holding_registers = [0] * NUM_REGISTERS
+        self.input_registers[REG_STATUS_ACQ] = STATE_MANUAL
+        self.measurements = 0
+        self.lock = threading.Lock()
+        self.timers = []
+
+        self.modbus_server = serve_socket(host, modbus_port)
+        self.modbus_port = self.modbus_server.getsockname()[1]
+        self.data_server = serve_socket(host, data_port)
+        self.data_port = self.data_server.getsockname()[1]
+        self.data_clients = []
+        self.modbus_clients = []
+        self.running = False
+        self.threads = []
+
+    @property
+    def state(self):
+        return self.input_registers[REG_STATUS_ACQ] & 0xFF
+
+    def set_state(self, state):
+        with self.lock:
+            self.input_registers[REG_STATUS_ACQ] = state
+            if state == STATE_RESULTS:
+                # Measurement counter, then the program result (number of defects here)
+                self.input_registers[REG_RESULTS] = self.measurements & 0xFFFF
+                self.input_registers[REG_RESULTS + 1] = self.defects_per_tile
+        if state == STATE_RESULTS:
+            self.push_result()
+
+    def start(self):
+        self.running = True
+        for target, name in ((self.serve_modbus, "modbus-sim"), (self.serve_data, "data-sim")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        self.running = False
+        for timer in self.timers:
+            timer.cancel()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        for conn in self.data_clients:
+            conn.close()
+        self.modbus_server.close()
+        self.data_server.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- state machine ---
+
+    def after(self, delay, state, expected = None):
+        """Move to state after delay, unless something else changed the state first."""
+        def fire():
+            if expected is None or self.state == expected:
+                self.set_state(state)
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        self.timers.append(timer)
+        timer.start()
+
+    def sequence(self, steps, expected):
+        """Run a chain of (delay, state) steps, each only if the previous one still holds."""
+        delay = 0
+        for step_delay, state in steps:
+            delay += step_delay
+            self.after(delay, state, expected)
+            expected = state
+
+    def write_control(self, value):
+        previous = self.holding_registers[REG_CONTROL_SMART]
+        self.holding_registers[REG_CONTROL_SMART] = value
+        state = self.state
+
+        if not value & BIT_AUTO_MODE:
+            self.set_state(STATE_MANUAL)
+        elif state == STATE_MANUAL:
+            self.after(self.auto_mode_time, STATE_READY, STATE_MANUAL)
+        elif state == STATE_READY and value & BIT_START and not previous & BIT_START:
+            self.measurements += 1
+            self.set_state(STATE_EXPOSURE)
+            self.sequence([
+                (self.exposure_time, STATE_PROCESSING),
+                (self.processing_time, STATE_EVALUATING),
+                (self.evaluation_time, STATE_RESULTS),
+            ], STATE_EXPOSURE)
+        elif state == STATE_RESULTS and value & BIT_RESULT_ACK:
+            self.after(self.ack_time, STATE_READY, STATE_RESULTS)
+
+    # --- Modbus TCP ---
+
+    def serve_modbus(self):
+        while self.running:
+            try:
+                conn, _ = self.modbus_server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(0.2)
+            self.modbus_clients.append(conn)
+            threading.Thread(target=self.handle_modbus, args=(conn,), name="modbus-sim-conn", daemon=True).start()
+
+    def handle_modbus(self, conn):
+        try:
+            with conn:
+                while self.running:
+                    header = recv_exactly(conn, 7, lambda: self.running)
+                    if header is None:
+                        return
+                    transaction, protocol, length, unit = struct.unpack(">HHHB", header)
+                    pdu = recv_exactly(conn, length - 1, lambda: self.running)
+                    if pdu is None:
+                        return
+                    response = self.handle_pdu(pdu)
+                    conn.sendall(struct.pack(">HHHB", transaction, protocol, len(response) + 1, unit) + response)
+        except OSError:
+            pass
+        finally:
+            if conn in self.modbus_clients:
+                self.modbus_clients.remove(conn)
+
+    def drop_modbus(self):
+        """Close every Modbus connection, as a network drop or sensor restart would."""
+        for conn in list(self.modbus_clients):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def handle_pdu(self, pdu):
+        function = pdu[0]
+        if function in (3, 4):
+            address, count = struct.unpack(">HH", pdu[1:5])
+            registers = self.holding_registers if function == 3 else self.input_registers
+            if address + count > NUM_REGISTERS:
+                return bytes([function | 0x80, 2])
+            with self.lock:
+                values = registers[address:address + count]
+            return struct.pack(f">BB{count}H", function, count * 2, *values)
+        if function == 6:
+            address, value = struct.unpack(">HH", pdu[1:5])
+            if address >= NUM_REGISTERS:
+                return bytes([function | 0x80, 2])
+            if address == REG_CONTROL_SMART:
+                self.write_control(value)
+            else:
+                self.holding_registers[address] = value
+            return pdu[:5]
+        if function == 16:
+            address, count, _ = struct.unpack(">HHB", pdu[1:6])
+            if address + count > NUM_REGISTERS:
+                return bytes([function | 0x80, 2])
+            values = struct.unpack(f">{count}H", pdu[6:6 + count * 2])
+            for offset, value in enumerate(values):
+                if address + offset == REG_CONTROL_SMART:
+                    self.write_control(value)
+                else:
+                    self.holding_registers[address + offset] = value
+            return struct.pack(">BHH", function, address, count)
+        return bytes([function | 0x80, 1])
+
+    # --- data stream ---
+
+    def serve_data(self):
+        while self.running:
+            try:
+                conn, _ = self.data_server.accept()
+            except socket.timeout:
+                continue
+            self.data_clients.append(conn)
+
+    def result_line(self):
+        """One result in the layout of a 3DInspect export row: Date Time, then u, v, recess per defect."""
+        fields = [datetime.now().strftime("%d/%m/%Y %H:%M:%S")]
+        for number in range(self.defects_per_tile):
+            fields += [f"{100.0 + 10 * number:.3f}", f"{50.0 + 5 * self.measurements:.3f}", f"{0.1 * (number + 1):.3f}"]
+        return "\t".join(fields) + "\r\n"
+
+    def push_result(self):
+        line = self.result_line()
+        if self.export_dir:
+            path = os.path.join(self.export_dir, f"auto_export_{self.measurements:05d}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(EXPORT_PREAMBLE + export_header(self.defects_per_tile) + "\n" + line)
+        payload = line.encode()
+        for conn in list(self.data_clients):
+            try:
+                conn.sendall(payload)
+            except OSError:
+                self.data_clients.remove(conn)
+
+
+class InspectSimulator:
+    def __init__(self, sensor: SensorSimulator, status_time = 0.2, export_time = 1.0):
+        self.sensor = sensor
+        self.status_time = status_time  # UIA connect + widget tree walk
+        self.export_time = export_time  # File -> Export defects dialog
+        self.exports = []
+
+    def read_status_text(self):
+        time.sleep(self.status_time)
+        return "Ready" if self.sensor.state == STATE_READY else "Busy"
+
+    def save_defect_file(self, filename = "defects_exported"):
+        time.sleep(self.export_time)
+        self.exports.append(filename)
+
+
+if __name__ == "__main__":
+    # Standalone: robot on 8000, Modbus on 5020, data stream on 5021 (502 needs root on Linux)
+    with RobotSimulator(port=8000) as robot, SensorSimulator(modbus_port=5020, data_port=5021) as sensor:
+        print(f"Robot simulator on {robot.host}:{robot.port}")
+        print(f"Sensor simulator Modbus on {sensor.host}:{sensor.modbus_port}, data on {sensor.data_port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("\nStopped by User.")
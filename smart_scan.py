@@ -0,0 +1,124 @@
+"""
+Smart rescan: re-inspect only the tiles of a finished sheet that need it instead of the whole sheet.
+
+A tile is rescanned when
+    - its deepest defect has a recess of at least RESCAN_MIN_RECESS (3DInspect always fills its
+      sort defect slots, so the number of defects doesn't tell tiles apart),
+    - one of its defects is missing its u, v or recess value (bad measurement), or
+    - the export has no result for it: no row, or a row with every defect field blank
+      (SheetExport writes those for tiles without a result).
+
+Tiles come from the sheet's scan_plan.json (tile_order.save_plan), or the raster plan of the configured
+sheet without one. Export rows are matched to tiles by their robot position in a sheet export, by scan
+order otherwise. The rescan starts at the tile nearest to where the sheet scan ended and is ordered
+nearest neighbour + 2-opt. Defect u, v are image pixels with no calibration to robot coordinates, so
+the unit of a rescan is the whole tile. Surface control tiles only, scan control targets are line pairs.
+
+process_data_v3 writes the rescan of a processed sheet next to it as rescan_plan.json, then
+
+    python smart_scan.py <output dir>           # rescan plan vs sheet, write motion.modx for it
+    python scanner_control.py rescan <output dir>
+"""
+
+import sys
+import numpy as np
+from motionplanning import get_coords, motion_to_txt
+from tile_order import Plan, plan_tiles, load_plan, save_plan, print_plans, nearest_order, two_opt, distance
+from config import *
+
+RESCAN_MIN_RECESS = 0.1 # mm
+RESCAN_PLAN_NAME = "rescan_plan.json"
+
+
+def sheet_plan(directory = None):
+    """The plan the sheet was scanned with, the configured raster plan if directory has none."""
+    plan = load_plan(directory) if directory else None
+    return plan or plan_tiles(get_coords(), "raster")
+
+
+def tile_rows(defect_table, plan):
+    """Tile index in plan of every row of the export, None for rows that don't belong to a tile."""
+    if defect_table.positions is not None:
+        tiles = []
+        for position in defect_table.positions:
+            if np.isnan(position[:2]).any():
+                tiles.append(None)
+                continue
+            tiles.append(min(range(len(plan)), key = lambda i: distance(plan.coords[i], position)))
+        return tiles
+    return [row if row < len(plan) else None for row in range(defect_table.num_images)]
+
+
+def tiles_to_rescan(defect_table, plan, min_recess = RESCAN_MIN_RECESS):
+    """{tile index in plan: reason} of every tile to scan again. defect_table None means no results at all."""
+    if defect_table is None:
+        return {tile: "no result" for tile in range(len(plan))}
+
+    counts = defect_table.counts()
+    incomplete = np.isnan(np.column_stack((defect_table.u, defect_table.v, defect_table.recess))).any(axis=1)
+    incomplete = np.bincount(defect_table.image[incomplete], minlength=defect_table.num_images)
+    deepest = np.zeros(defect_table.num_images)
+    np.maximum.at(deepest, defect_table.image, np.nan_to_num(defect_table.recess))
+
+    reasons = {}
+    seen = set()
+    for row, tile in enumerate(tile_rows(defect_table, plan)):
+        if tile is None or not counts[row]:
+            continue
+        seen.add(tile)
+        if incomplete[row]:
+            reasons[tile] = "incomplete defects"
+        elif deepest[row] >= min_recess:
+            reasons[tile] = "deep defects"
+    for tile in range(len(plan)):
+        if tile not in seen:
+            reasons[tile] = "no result"
+    return reasons
+
+
+def plan_rescan(plan, tiles, start = None):
+    """Plan visiting tiles (indices into plan) from start, by default the last tile of the sheet scan.
+    Every tile keeps its grid cell from plan."""
+    tiles = sorted(tiles)
+    if not tiles:
+        return Plan("rescan", [], [])
+    start = plan.coords[-1] if start is None else start
+    coords = [plan.coords[tile] for tile in tiles]
+    first = min(range(len(coords)), key = lambda i: distance(start, coords[i]))
+    order = two_opt(coords, nearest_order(coords, start=first))
+    return Plan("rescan", [list(coords[i]) for i in order], [tuple(plan.cells[tiles[i]]) for i in order])
+
+
+def get_smart_coords(defect_table, directory = None, min_recess = RESCAN_MIN_RECESS):
+    """Robot coordinates of the rescan for a sheet's defect results, in visiting order
+    (for Crb.send_coords / motion_to_txt(..., ordering=None))."""
+    plan = sheet_plan(directory)
+    return plan_rescan(plan, tiles_to_rescan(defect_table, plan, min_recess)).coords
+
+
+def save_rescan(defect_table, directory, min_recess = RESCAN_MIN_RECESS):
+    """Plan the rescan of the sheet processed into directory and write it there as rescan_plan.json."""
+    plan = sheet_plan(directory)
+    reasons = tiles_to_rescan(defect_table, plan, min_recess)
+    rescan = plan_rescan(plan, reasons)
+    save_plan(rescan, directory, RESCAN_PLAN_NAME)
+    summary = ", ".join(f"{list(reasons.values()).count(reason)} {reason}" for reason in sorted(set(reasons.values())))
+    print(f"Rescan: {len(rescan)} of {len(plan)} tiles ({summary or 'nothing to rescan'}), {rescan.distance / 1000:.2f} m")
+    return rescan
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python smart_scan.py <processed sheet directory>")
+        sys.exit(1)
+    rescan = load_plan(sys.argv[1], RESCAN_PLAN_NAME)
+    if rescan is None:
+        print(f"No {RESCAN_PLAN_NAME} in {sys.argv[1]}, process the sheet first.")
+        sys.exit(1)
+    print_plans([sheet_plan(sys.argv[1]), rescan])
+    if not rescan.coords:
+        print("Nothing to rescan.")
+        sys.exit(0)
+    written = motion_to_txt(coords=rescan.coords, module_name=module_name, do_pulse=do_pulses, wait_time=wait_time,
+                            orientation=camera.orientation, ordering=None)
+    print(f"motion.modx {'updated' if written else 'unchanged'}, {len(rescan)} tiles")
@@ -0,0 +1,193 @@
+"""
+Order in which the tiles of a sheet are visited.
+
+Orderings (plan_tiles / ORDERINGS):
+    raster      - column by column along y, x ascending in every column (the original sort)
+    serpentine  - column by column along y, x direction alternating so there are no return moves
+    nearest     - nearest neighbour tour from the first raster tile, improved with 2-opt
+    singularity - like nearest, but every tile on one side of the robot's centre line (y = SINGULARITY_Y)
+                  is visited before crossing it, so the wrist singularity is only passed once
+
+Every plan keeps the (row, col) of each tile in the stitching grid (row = x index, col = y index, as
+process_data_v3.get_grid_info), written next to the scan as scan_plan.json so stitching doesn't
+rely on the tiles arriving in raster order.
+
+    python tile_order.py    # distance and time of every ordering for the configured sheet
+"""
+
+import os
+import json
+import math
+from config import TILE_ORDER, SCAN_PLAN_NAME
+
+ORDERINGS = ("raster", "serpentine", "nearest", "singularity")
+
+SINGULARITY_Y = 0.0  # mm, robot base axis
+ROBOT_SPEED = 500.0  # mm/s, v500 in the RAPID module
+ROBOT_ACCEL = 2000.0 # mm/s^2, estimate for the loaded arm
+STOP_TIME = 0.2      # s per tile, fine point plus WaitTime before READY
+
+
+class Plan:
+    def __init__(self, ordering, coords, cells):
+        self.ordering = ordering
+        self.coords = coords  # visiting order
+        self.cells = cells    # (row, col) in the stitching grid of each entry of coords
+        self.distance = path_distance(coords)
+        self.time = path_time(coords)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __str__(self):
+        return f"{self.ordering:<12}{len(self.coords):>6}{self.distance / 1000:>12.2f}{self.time:>10.1f}"
+
+
+def distance(a, b):
+    return math.dist(a[:2], b[:2])
+
+
+def move_time(d, speed = ROBOT_SPEED, accel = ROBOT_ACCEL):
+    """Time for a point to point move of d mm with a trapezoidal (or triangular) speed profile."""
+    if d <= 0:
+        return 0.0
+    if d < speed * speed / accel:
+        return 2 * math.sqrt(d / accel)
+    return d / speed + speed / accel
+
+
+def path_distance(coords):
+    return sum(distance(a, b) for a, b in zip(coords, coords[1:]))
+
+
+def path_time(coords):
+    return sum(move_time(distance(a, b)) for a, b in zip(coords, coords[1:])) + STOP_TIME * len(coords)
+
+
+def grid_cells(coords):
+    """(row, col) of every coordinate, rows along x and columns along y."""
+    xs = sorted({p[0] for p in coords})
+    ys = sorted({p[1] for p in coords})
+    row_of = {x: r for r, x in enumerate(xs)}
+    col_of = {y: c for c, y in enumerate(ys)}
+    return [(row_of[p[0]], col_of[p[1]]) for p in coords]
+
+
+def raster_order(coords):
+    return sorted(range(len(coords)), key = lambda i: (coords[i][1], coords[i][0]))
+
+
+def serpentine_order(coords):
+    order = []
+    columns = {}
+    for i in range(len(coords)):
+        columns.setdefault(coords[i][1], []).append(i)
+    for n, y in enumerate(sorted(columns)):
+        column = sorted(columns[y], key = lambda i: coords[i][0])
+        order += column if n % 2 == 0 else column[::-1]
+    return order
+
+
+def nearest_order(coords, indices = None, start = None):
+    """Greedy nearest neighbour path through indices (default: all), starting at start."""
+    remaining = list(range(len(coords))) if indices is None else list(indices)
+    if not remaining:
+        return []
+    current = remaining[0] if start is None else start
+    remaining.remove(current)
+    order = [current]
+    while remaining:
+        current = min(remaining, key = lambda i: distance(coords[current], coords[i]))
+        remaining.remove(current)
+        order.append(current)
+    return order
+
+
+def two_opt(coords, order):
+    """Reverse segments of the open path while that shortens it. The first tile stays first."""
+    order = list(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(order) - 1):
+            for j in range(i + 1, len(order)):
+                a, b = coords[order[i - 1]], coords[order[i]]
+                c = coords[order[j]]
+                before = distance(a, b)
+                after = distance(a, c)
+                if j + 1 < len(order):
+                    d = coords[order[j + 1]]
+                    before += distance(c, d)
+                    after += distance(b, d)
+                if after < before - 1e-9:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+    return order
+
+
+def singularity_order(coords):
+    start = raster_order(coords)[0]
+    first_side = coords[start][1] < SINGULARITY_Y
+    near = [i for i in range(len(coords)) if (coords[i][1] < SINGULARITY_Y) == first_side]
+    far = [i for i in range(len(coords)) if (coords[i][1] < SINGULARITY_Y) != first_side]
+
+    order = two_opt(coords, nearest_order(coords, near, start))
+    if far:
+        # Cross the centre line once, from wherever the first side ended
+        entry = min(far, key = lambda i: distance(coords[order[-1]], coords[i]))
+        order += two_opt(coords, nearest_order(coords, far, entry))
+    return order
+
+
+def plan_tiles(coords, ordering = TILE_ORDER):
+    """Plan visiting coords with one of ORDERINGS. coords itself is left as it is."""
+    # Start from raster order so the plan only depends on the set of tiles, not how they were listed
+    coords = [coords[i] for i in raster_order(coords)]
+    cells = grid_cells(coords)
+    if ordering == "raster":
+        order = raster_order(coords)
+    elif ordering == "serpentine":
+        order = serpentine_order(coords)
+    elif ordering == "nearest":
+        order = two_opt(coords, nearest_order(coords, start=raster_order(coords)[0]))
+    elif ordering == "singularity":
+        order = singularity_order(coords)
+    else:
+        raise ValueError(f"Unknown tile ordering {ordering!r}, expected one of {ORDERINGS}")
+    return Plan(ordering, [list(coords[i]) for i in order], [cells[i] for i in order])
+
+
+def save_plan(plan, directory, name = SCAN_PLAN_NAME):
+    """Write scan_plan.json into directory (where the sheet's tiles and exports go)."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"ordering": plan.ordering, "cells": plan.cells, "coords": plan.coords}, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_plan(directory, name = SCAN_PLAN_NAME):
+    """The plan save_plan wrote into directory, None if there is none."""
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        data = json.load(f)
+    return Plan(data["ordering"], data["coords"], [tuple(cell) for cell in data["cells"]])
+
+
+def compare_orderings(coords):
+    return [plan_tiles(coords, ordering) for ordering in ORDERINGS]
+
+
+def print_plans(plans):
+    print(f"{'ordering':<12}{'tiles':>6}{'travel m':>12}{'time s':>10}")
+    for plan in plans:
+        print(plan)
+
+
+if __name__ == "__main__":
+    from motionplanning import get_coords
+    print_plans(compare_orderings(get_coords()))
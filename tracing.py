@@ -0,0 +1,114 @@
+"""
+Cycle time tracing. Every timed section is written as one JSON line as soon as it finishes:
+    {"name": "phase.trigger", "start": <unix time>, "duration": <s>, "thread": ..., <attrs>}
+Phases are named "phase.*", single Modbus/socket round trips "modbus.*" and "robot.*".
+
+Run `python tracing.py traces/<sheet>.jsonl` for p50/p95 per span name.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+TRACE_DIR = "traces"
+
+
+class Tracer:
+    def __init__(self, path = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+
+    @classmethod
+    def for_sheet(cls, directory = TRACE_DIR):
+        """A tracer writing to a new file for this sheet."""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return cls(os.path.join(directory, f"sheet_{timestamp}.jsonl"))
+
+    @contextmanager
+    def span(self, name, **attrs):
+        if not self.file:
+            yield
+            return
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.write(name, start, time.perf_counter() - t0, attrs)
+
+    def event(self, name, duration, **attrs):
+        """Record a span that was timed elsewhere."""
+        if self.file:
+            self.write(name, time.time() - duration, duration, attrs)
+
+    def write(self, name, start, duration, attrs):
+        record = {"name": name, "start": start, "duration": duration, "thread": threading.current_thread().name}
+        record.update(attrs)
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# Default for drivers that haven't been given a tracer, records nothing
+NULL_TRACER = Tracer()
+
+
+def percentile(values, p):
+    """Nearest rank percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def summarize(path):
+    """{span name: {"count", "total", "mean", "p50", "p95", "max"}} for a trace file."""
+    durations = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            durations.setdefault(record["name"], []).append(record["duration"])
+
+    summary = {}
+    for name, values in durations.items():
+        values.sort()
+        summary[name] = {
+            "count": len(values),
+            "total": sum(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": values[-1],
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'span':<28}{'count':>7}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, s in sorted(summary.items(), key = lambda item: -item[1]["total"]):
+        print(f"{name:<28}{s['count']:>7}{s['total']:>10.2f}{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}{s['max'] * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python tracing.py <trace.jsonl>")
+        sys.exit(1)
+    print_summary(summarize(sys.argv[1]))